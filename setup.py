@@ -41,6 +41,7 @@ setup(
     # packages=find_packages(exclude=["tests"]),
     python_requires=">=3.7, <4",
     install_requires=["requests>=2"],
+    extras_require={"orjson": ["orjson>=3"], "ujson": ["ujson>=2"]},
     include_package_data=True,
     tests_require=["pytest"],
     project_urls={
@@ -0,0 +1,39 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+import pytest
+
+from usagelogger import AdaptiveSampler
+
+
+def test_validates_options():
+    with pytest.raises(ValueError):
+        AdaptiveSampler(min_rate=0)
+    with pytest.raises(ValueError):
+        AdaptiveSampler(decrease=1.0)
+
+
+def test_decreases_under_queue_pressure():
+    sampler = AdaptiveSampler(queue_threshold=0.5, min_rate=5, interval=0)
+    assert sampler.rate == 100
+    assert sampler.update(0.2) == 100
+    assert [sampler.update(0.6) for _ in range(5)] == [50, 25, 12.5, 6.25, 5]
+    assert [sampler.update(0.1) for _ in range(3)] == [15, 25, 35]
+
+
+def test_decreases_under_latency_pressure():
+    sampler = AdaptiveSampler(latency_threshold=1.0, interval=0)
+    assert sampler.latency is None
+    sampler.record_latency(3.0)
+    assert sampler.latency == 3.0
+    assert sampler.update(0) == 50
+    for _ in range(10):
+        sampler.record_latency(0.1)
+    assert sampler.latency < 1.0
+    assert sampler.update(0) == 60
+
+
+def test_waits_for_interval():
+    sampler = AdaptiveSampler(interval=60)
+    assert sampler.update(1.0) == 100
+    assert sampler.update(1.0) == 100
@@ -0,0 +1,263 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+import asyncio
+import json
+import threading
+import time
+import zlib
+
+import pytest
+
+from tests.test_helper import (
+    mock_request_with_json2,
+    mock_response_with_html,
+    parseable,
+)
+from usagelogger import AsyncHttpLogger, CircuitBreaker, RetryPolicy
+
+
+def test_creates_instance():
+    logger = AsyncHttpLogger()
+    assert logger is not None
+    assert logger.agent == AsyncHttpLogger.AGENT
+    assert logger.enableable is False
+    assert logger.enabled is False
+
+
+def test_logs_from_event_loop():
+    queue = []
+    logger = AsyncHttpLogger(queue=queue, rules="include debug")
+
+    async def main():
+        for _ in range(3):
+            logger.enqueue(
+                request=mock_request_with_json2(), response=mock_response_with_html()
+            )
+        assert len(queue) == 0
+        await logger.aflush()
+
+    asyncio.run(main())
+    assert len(queue) == 3
+    assert all(parseable(msg) for msg in queue)
+    assert '["request_method","POST"]' in queue[0]
+    assert logger.submit_successes == 3
+
+
+def test_flushes_and_closes_from_other_threads():
+    queue = []
+    logger = AsyncHttpLogger(queue=queue, rules="include debug", batch_interval=60)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+
+    async def enqueue():
+        logger.enqueue(
+            request=mock_request_with_json2(), response=mock_response_with_html()
+        )
+
+    try:
+        asyncio.run_coroutine_threadsafe(enqueue(), loop).result(5)
+        logger.flush()
+        assert len(queue) == 1
+
+        async def close_on_loop():
+            logger.close()
+
+        with pytest.raises(RuntimeError):
+            asyncio.run_coroutine_threadsafe(close_on_loop(), loop).result(5)
+        logger.close(5)
+        assert logger._task is None
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+        loop.close()
+    logger.close()  # nothing left running
+
+
+def test_closes_session_left_on_earlier_loop():
+    queue = []
+    logger = AsyncHttpLogger(queue=queue, rules="include debug")
+    closed = []
+
+    class Session:
+        async def close(self):
+            closed.append(asyncio.get_running_loop())
+
+    async def main():
+        logger.enqueue(
+            request=mock_request_with_json2(), response=mock_response_with_html()
+        )
+        await logger.aflush()
+        return asyncio.get_running_loop()
+
+    asyncio.run(main())
+    logger._session = Session()
+    loop = asyncio.run(main())
+    assert closed == [loop]
+    assert logger._session is None
+    assert len(queue) == 2
+
+
+def test_applies_rules_off_event_loop():
+    queue = []
+    logger = AsyncHttpLogger(queue=queue, rules="!response_body! stop")
+
+    async def main():
+        logger.enqueue(
+            request=mock_request_with_json2(), response=mock_response_with_html()
+        )
+        await logger.aflush()
+
+    asyncio.run(main())
+    assert len(queue) == 0
+
+
+def test_submits_batches_to_url():
+    from aiohttp import web
+
+    bodies = []
+
+    async def collect(request):
+        assert request.headers["Content-Encoding"] == "deflated"
+        bodies.append(zlib.decompress(await request.read()))
+        return web.Response(status=204)
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/message", collect)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            logger = AsyncHttpLogger(
+                url=f"http://127.0.0.1:{port}/message",
+                rules="allow_http_url\ninclude debug",
+                batch_interval=60,
+            )
+            for _ in range(5):
+                logger.enqueue(
+                    request=mock_request_with_json2(),
+                    response=mock_response_with_html(),
+                )
+            await logger.aclose()
+            return logger
+        finally:
+            await runner.cleanup()
+
+    logger = asyncio.run(main())
+    assert len(bodies) == 1
+    assert len(bodies[0].split(b"\n")) == 5
+    assert logger.submit_successes == 1
+    assert logger.submit_failures == 0
+
+
+def test_counts_failed_items_and_keeps_running():
+    queue = []
+    logger = AsyncHttpLogger(queue=queue, rules="include debug")
+
+    async def main():
+        logger.enqueue(request=None, response=mock_response_with_html())
+        logger.enqueue(
+            request=mock_request_with_json2(), response=mock_response_with_html()
+        )
+        await logger.aflush()
+        logger.enqueue(
+            request=mock_request_with_json2(), response=mock_response_with_html()
+        )
+        await logger.aflush()
+
+    asyncio.run(main())
+    assert len(queue) == 2
+    assert logger.submit_failures == 1
+
+
+def test_stamps_messages_when_enqueued():
+    queue = []
+    logger = AsyncHttpLogger(queue=queue, rules="include debug", batch_interval=0.2)
+
+    async def main():
+        logger.enqueue(
+            request=mock_request_with_json2(), response=mock_response_with_html()
+        )
+        enqueued = round(time.time() * 1000)
+        await logger.aflush()
+        return enqueued
+
+    enqueued = asyncio.run(main())
+    now = int(dict(json.loads(queue[0]))["now"])
+    assert enqueued - 50 <= now <= enqueued
+
+
+def submit_to_collector(statuses, **kwargs):
+    from aiohttp import web
+
+    statuses = list(statuses)
+    posts = []
+
+    async def collect(request):
+        posts.append(await request.read())
+        return web.Response(status=statuses.pop(0) if statuses else 204)
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/message", collect)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            logger = AsyncHttpLogger(
+                url=f"http://127.0.0.1:{port}/message",
+                rules="allow_http_url\ninclude debug",
+                **kwargs,
+            )
+            for _ in range(3):
+                logger.enqueue(
+                    request=mock_request_with_json2(),
+                    response=mock_response_with_html(),
+                )
+                await logger.aflush()
+            await logger.aclose()
+            return logger
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(main()), posts
+
+
+def test_retries_retryable_failures():
+    policy = RetryPolicy(max_attempts=3, backoff=0.001)
+    logger, posts = submit_to_collector([503, 502], retry_policy=policy)
+    assert len(posts) == 5
+    assert logger.submit_successes == 3
+    assert logger.submit_failures == 0
+
+
+def test_fails_fast_while_circuit_is_open():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    logger, posts = submit_to_collector([503], circuit_breaker=breaker)
+    assert len(posts) == 1
+    assert logger.submit_failures == 1
+    assert logger.submit_dropped == 2
+
+
+def test_leaves_circuit_closed_for_rejected_batches():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    logger, posts = submit_to_collector([400, 413], circuit_breaker=breaker)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert len(posts) == 3
+    assert logger.submit_failures == 2
+    assert logger.submit_successes == 1
+
+
+def test_rejects_sync_only_options():
+    for option in AsyncHttpLogger.SYNC_ONLY:
+        try:
+            AsyncHttpLogger(**{option: None})
+            assert False is True
+        except TypeError as e:
+            assert str(e) == f"AsyncHttpLogger does not support {option}"
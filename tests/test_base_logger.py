@@ -1,9 +1,31 @@
 # coding: utf-8
 # © 2016-2024 Graylog, Inc.
-
-
-from tests.test_helper import DEMO_URL, MOCK_AGENT, MOCK_URLS_DENIED, MOCK_URLS_INVALID
-from usagelogger import BaseLogger, UsageLoggers
+import os
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+from tests.test_helper import (
+    DEMO_URL,
+    MOCK_AGENT,
+    MOCK_URLS_DENIED,
+    MOCK_URLS_INVALID,
+    MockSession,
+)
+from usagelogger import (
+    BaseLogger,
+    CircuitBreaker,
+    DiskSpool,
+    RetryPolicy,
+    UsageLoggers,
+)
+from usagelogger.base_logger import EnclosureQueue, NdjsonBatch, _live_loggers
+
+
+def mock_payload(size=10):
+    return {"msg": [["now", "1"]], "size": size}
 
 
 def test_creates_instance():
@@ -124,6 +146,325 @@ def test_submits_to_denied_url():
         assert logger.submit_successes == 0
 
 
+def test_submits_batches_by_size(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession()
+    logger = BaseLogger(
+        MOCK_AGENT, url=DEMO_URL, conn=conn, batch_size=3, batch_interval=60
+    )
+    for i in range(7):
+        logger.submit([["now", str(i)]])
+    logger.flush()
+    assert [len(p["body"].split(b"\n")) for p in conn.posts] == [3, 3, 1]
+    assert all(p["url"] == DEMO_URL for p in conn.posts)
+    assert logger.submit_failures == 0
+    assert logger.submit_successes == 3
+
+
+def test_submits_batches_by_bytes(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession()
+    logger = BaseLogger(
+        MOCK_AGENT, url=DEMO_URL, conn=conn, batch_bytes=60, batch_interval=60
+    )
+    for i in range(4):
+        logger.submit([["request_body", "x" * 10]])
+    logger.flush()
+    assert [len(p["body"].split(b"\n")) for p in conn.posts] == [2, 2]
+
+
+def test_submits_batches_by_interval(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession()
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, batch_interval=0.05)
+    logger.submit([["now", "1"]])
+    logger.submit([["now", "2"]])
+    for _ in range(100):
+        if conn.posts:
+            break
+        time.sleep(0.01)
+    assert len(conn.posts) == 1
+    assert conn.posts[0]["body"] == b'[["now","1"]]\n[["now","2"]]'
+
+
+def test_drops_newest_when_queue_full():
+    q = EnclosureQueue()
+    newest = mock_payload()
+    assert q.offer(mock_payload(), 2, 1000) == []
+    assert q.offer(mock_payload(), 2, 1000) == []
+    assert q.offer(newest, 2, 1000) == [newest]
+    assert q.qsize() == 2
+    assert q.bytes == 20
+
+
+def test_drops_newest_when_queue_bytes_exceeded():
+    q = EnclosureQueue()
+    assert q.offer(mock_payload(), 100, 25) == []
+    assert q.offer(mock_payload(), 100, 25) == []
+    assert len(q.offer(mock_payload(), 100, 25)) == 1
+    assert q.offer(mock_payload(size=5), 100, 25) == []
+    assert q.bytes == 25
+
+
+def test_drops_oldest_when_queue_full():
+    q = EnclosureQueue()
+    first, second, third = (mock_payload() for _ in range(3))
+    q.offer(first, 2, 1000, "drop_oldest")
+    q.offer(second, 2, 1000, "drop_oldest")
+    assert q.offer(third, 2, 1000, "drop_oldest") == [first]
+    assert list(q.queue) == [second, third]
+    assert q.unfinished_tasks == 2
+
+
+def test_blocks_when_queue_full():
+    q = EnclosureQueue()
+    q.offer(mock_payload(), 1, 1000, "block")
+    assert len(q.offer(mock_payload(), 1, 1000, "block", 0.05)) == 1
+
+    threading.Timer(0.05, q.get).start()
+    assert q.offer(mock_payload(), 1, 1000, "block", 5.0) == []
+    assert q.qsize() == 1
+
+
+def test_samples_down_when_queue_filling():
+    q = EnclosureQueue()
+    dropped = [q.offer(mock_payload(), 10, 1000, "sample") for _ in range(100)]
+    assert not any(dropped[:5])
+    assert 5 <= q.qsize() <= 10
+
+
+def test_counts_dropped_submissions(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, queue_size=1, overflow="block")
+    logger._enclosure_queue.offer(mock_payload(), 1, 1000)
+    logger.submit([["now", "1"]])
+    assert logger.submit_dropped == 1
+
+
+def test_rejects_invalid_overflow_policy():
+    try:
+        BaseLogger(MOCK_AGENT, url=DEMO_URL, overflow="drop_everything")
+        assert False is True
+    except ValueError as e:
+        assert str(e) == "Invalid overflow policy: drop_everything"
+
+
+def test_submits_through_separate_pipelines(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    url1 = "https://collector1.example.com/message"
+    url2 = "https://collector2.example.com/message"
+    stalled = threading.Event()
+
+    class StalledSession(MockSession):
+        def post(self, url, data=None, headers=None, **kwargs):
+            stalled.wait(5)
+            return super().post(url, data, headers, **kwargs)
+
+    conn1 = StalledSession()
+    conn2 = MockSession()
+    logger1 = BaseLogger("agent1", url=url1, conn=conn1, batch_interval=0.01)
+    logger2 = BaseLogger("agent2", url=url2, conn=conn2, batch_interval=0.01)
+    logger1.submit([["now", "1"]])
+    logger2.submit([["now", "2"]])
+    logger2.flush()
+    assert len(conn1.posts) == 0
+    assert len(conn2.posts) == 1
+    assert conn2.posts[0]["url"] == url2
+    assert conn2.posts[0]["body"] == b'[["now","2"]]'
+    assert "(agent2)" in conn2.posts[0]["headers"]["User-Agent"]
+
+    stalled.set()
+    logger1.flush()
+    assert len(conn1.posts) == 1
+    assert conn1.posts[0]["url"] == url1
+    assert conn1.posts[0]["body"] == b'[["now","1"]]'
+    assert "(agent1)" in conn1.posts[0]["headers"]["User-Agent"]
+
+
+def test_compresses_whole_batches(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    expected = b"\n".join(b'[["now","%d"]]' % i for i in range(50))
+    for compression, encoding in [("deflate", "deflated"), ("gzip", "gzip")]:
+        conn = MockSession()
+        logger = BaseLogger(
+            MOCK_AGENT,
+            url=DEMO_URL,
+            conn=conn,
+            compression=compression,
+            compression_level=9,
+            batch_interval=60,
+        )
+        for i in range(50):
+            logger.submit([["now", str(i)]])
+        logger.flush()
+        assert len(conn.posts) == 1
+        assert conn.posts[0]["headers"]["Content-Encoding"] == encoding
+        assert conn.posts[0]["body"] == expected
+        assert len(conn.posts[0]["data"]) < len(expected)
+
+
+def test_skips_compression_when_requested(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession()
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, skip_compression=True)
+    logger.submit([["now", "1"]])
+    logger.flush()
+    assert "Content-Encoding" not in conn.posts[0]["headers"]
+    assert conn.posts[0]["data"] == b'[["now","1"]]'
+
+
+def test_rejects_invalid_compression():
+    try:
+        BaseLogger(MOCK_AGENT, url=DEMO_URL, compression="brotli")
+        assert False is True
+    except ValueError as e:
+        assert str(e) == "Invalid compression: brotli"
+
+
+def test_spools_failed_batches_and_replays_in_order(monkeypatch, tmp_path):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession(status_code=503)
+    spool = DiskSpool(tmp_path)
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, spool=spool)
+    logger.submit([["now", "1"]])
+    logger.flush()
+    logger.submit([["now", "2"]])
+    logger.flush()
+    assert logger.submit_failures == 2
+    assert spool.empty is False
+
+    conn.status_code = 204
+    logger.submit([["now", "3"]])
+    logger.flush()
+    assert spool.empty is True
+    assert conn.posts[-1]["body"] == b'[["now","1"]]\n[["now","2"]]\n[["now","3"]]'
+    assert logger.submit_dropped == 0
+
+
+def test_spools_under_back_pressure(monkeypatch, tmp_path):
+    monkeypatch.setenv("DEBUG", "False")
+    spool = DiskSpool(tmp_path)
+    logger = BaseLogger(
+        MOCK_AGENT, url=DEMO_URL, conn=MockSession(503), queue_size=1, spool=spool
+    )
+    logger._enclosure_queue.offer(mock_payload(), 1, 1000)
+    logger.submit([["now", "2"]])
+    assert logger.submit_dropped == 0
+    assert spool.peek(10, 1000) == (['[["now","2"]]'], 14)
+
+
+def test_drops_deferred_messages_under_back_pressure(monkeypatch, tmp_path):
+    monkeypatch.setenv("DEBUG", "False")
+    spool = DiskSpool(tmp_path)
+    logger = BaseLogger(
+        MOCK_AGENT, url=DEMO_URL, conn=MockSession(503), queue_size=1, spool=spool
+    )
+    logger._enclosure_queue.offer(mock_payload(), 1, 1000)
+    built = []
+    logger.submit_deferred(lambda: built.append(1) or [["now", "2"]], 20)
+    assert built == []
+    assert logger.submit_dropped == 1
+    assert spool.empty is True
+
+
+def test_retries_retryable_failures(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession(statuses=[503, 502])
+    policy = RetryPolicy(max_attempts=3, backoff=0.001)
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, retry_policy=policy)
+    logger.submit([["now", "1"]])
+    logger.flush()
+    assert len(conn.posts) == 3
+    assert logger.submit_successes == 1
+    assert logger.submit_failures == 0
+
+    conn = MockSession(status_code=503)
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, retry_policy=policy)
+    logger.submit([["now", "1"]])
+    logger.flush()
+    assert len(conn.posts) == 3
+    assert logger.submit_failures == 1
+
+
+def test_skips_retry_for_other_failures(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession(status_code=400)
+    policy = RetryPolicy(max_attempts=3, backoff=0.001)
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, retry_policy=policy)
+    logger.submit([["now", "1"]])
+    logger.flush()
+    assert len(conn.posts) == 1
+    assert logger.submit_failures == 1
+
+
+def test_fails_fast_while_circuit_open(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession(status_code=503)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, circuit_breaker=breaker)
+    for i in range(5):
+        logger.submit([["now", str(i)]])
+        logger.flush()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert len(conn.posts) == 2
+    assert logger.submit_failures == 2
+    assert logger.submit_dropped == 3
+
+
+def test_leaves_circuit_closed_for_rejected_batches(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession(status_code=400)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, circuit_breaker=breaker)
+    for i in range(3):
+        logger.submit([["now", str(i)]])
+        logger.flush()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert len(conn.posts) == 3
+    assert logger.submit_failures == 3
+
+
+def test_reopens_circuit_when_probe_cannot_be_sent(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, circuit_breaker=breaker)
+
+    def fail():
+        raise zlib.error("broken stream")
+
+    monkeypatch.setattr(NdjsonBatch, "getvalue", lambda self: fail())
+    logger.submit([["now", "1"]])
+    logger.flush()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert conn.posts == []
+    assert logger.submit_failures == 1
+
+
+def test_builds_deferred_messages_on_worker(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession()
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, batch_interval=60)
+    threads = []
+
+    def build(i):
+        threads.append(threading.current_thread().name)
+        if i == 1:
+            return None
+        if i == 2:
+            raise ValueError("broken builder")
+        return [["now", str(i)]]
+
+    for i in range(4):
+        logger.submit_deferred(lambda i=i: build(i), 20)
+    logger.flush()
+    assert threads == ["submission_thread"] * 4
+    assert conn.posts[0]["body"] == b'[["now","0"]]\n[["now","3"]]'
+    assert logger.submit_failures == 1
+    assert logger.submit_successes == 1
+
+
 def test_submits_to_queue():
     queue = []
     logger = BaseLogger(MOCK_AGENT, queue=queue, url=MOCK_URLS_DENIED[0])
@@ -203,3 +544,98 @@ def test_uses_skip_options():
     logger.skip_submission = True
     assert logger.skip_compression is False
     assert logger.skip_submission is True
+
+
+def test_drops_rejected_batches_instead_of_spooling(monkeypatch, tmp_path):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession(statuses=[400])
+    spool = DiskSpool(tmp_path)
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, spool=spool)
+    logger.submit([["now", "1"]])
+    logger.flush()
+    assert spool.empty is True
+    logger.submit([["now", "2"]])
+    logger.flush()
+    assert len(conn.posts) == 2
+    assert logger.submit_successes == 1
+    assert logger.submit_failures == 1
+
+
+def test_skips_rejected_batches_on_replay(monkeypatch, tmp_path):
+    monkeypatch.setenv("DEBUG", "False")
+    spool = DiskSpool(tmp_path)
+    spool.append(["not json"])
+    conn = MockSession(statuses=[400])
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, spool=spool)
+    logger.submit([["now", "1"]])
+    logger.flush()
+    assert spool.empty is True
+    assert conn.posts[0]["body"] == b'not json\n[["now","1"]]'
+    logger.submit([["now", "2"]])
+    logger.flush()
+    assert conn.posts[1]["body"] == b'[["now","2"]]'
+    assert logger.submit_successes == 1
+    assert logger.submit_failures == 1
+
+
+def test_closes_after_sending_batched_messages(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession()
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, batch_interval=60)
+    logger.submit([["now", "1"]])
+    worker = logger._worker
+    logger.close()
+    assert not worker.is_alive()
+    assert conn.posts[0]["body"] == b'[["now","1"]]'
+    logger.submit([["now", "2"]])
+    logger.close()
+    assert len(conn.posts) == 2
+
+
+def test_sends_batched_messages_at_exit():
+    script = (
+        "import atexit\n"
+        "atexit.register(lambda: print(len(conn.posts)))\n"  # runs last
+        "from tests.test_helper import DEMO_URL, MOCK_AGENT, MockSession\n"
+        "from usagelogger import BaseLogger\n"
+        "conn = MockSession()\n"
+        "logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, batch_interval=60)\n"
+        "logger.submit([['now', '1']])\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env={**os.environ, "DEBUG": "False"},
+        text=True,
+        timeout=30,
+    )
+    assert result.stdout.strip() == "1", result.stderr
+
+
+def test_holds_running_loggers_until_closed(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=MockSession())
+    assert logger not in _live_loggers
+    logger.submit([["now", "1"]])
+    assert logger in _live_loggers
+    logger.close()
+    assert logger not in _live_loggers
+
+
+def test_posts_uncompressed_batches_without_copying(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    sent = []
+
+    class SharingSession(MockSession):
+        def post(self, url, data=None, headers=None, **kwargs):
+            sent.append(data)
+            return super().post(url, data, headers, **kwargs)
+
+    conn = SharingSession()
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, skip_compression=True)
+    for i in range(2):
+        logger.submit([["now", str(i)]])
+        logger.flush()
+    assert isinstance(sent[0], bytearray)
+    assert [p["body"] for p in conn.posts] == [b'[["now","0"]]', b'[["now","1"]]']
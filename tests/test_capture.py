@@ -0,0 +1,89 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+from usagelogger.utils.capture import (
+    capture_body,
+    charset,
+    decode_body,
+    header_value,
+    is_textual,
+    looks_binary,
+    truncate_text,
+)
+
+PNG = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR"
+
+
+def test_truncates_between_characters():
+    body = "ab€".encode("utf-8")
+    assert decode_body(body) == "ab€"
+    assert decode_body(body, 5) == "ab€"
+    assert decode_body(body, 4) == "ab"
+    assert decode_body(body, 1) == "a"
+    assert decode_body("ab€", 2) == "ab"
+    assert decode_body("ab€", 4) == "ab"
+    assert decode_body(None, 2) is None
+
+
+def test_truncates_text_by_encoded_size():
+    assert truncate_text("ab€", 5) == "ab€"
+    assert truncate_text("ab€", 4) == "ab"
+    assert truncate_text("€€€", 7) == "€€"
+    assert truncate_text("abcdef", 3) == "abc"
+    assert len(truncate_text("€" * 1000, 100).encode("utf-8")) <= 100
+
+
+def test_recognizes_textual_types():
+    for t in [
+        "text/html; charset=utf-8",
+        "Application/JSON",
+        "application/vnd.api+json",
+        "application/problem+json",
+        "application/soap+xml",
+        "application/x-www-form-urlencoded",
+        "multipart/form-data; boundary=xyz",
+    ]:
+        assert is_textual(t) is True
+    for t in ["image/png", "application/octet-stream", "application/x-protobuf"]:
+        assert is_textual(t) is False
+    assert is_textual(None) is None
+    assert is_textual("") is None
+
+
+def test_sniffs_binary():
+    assert looks_binary(PNG) is True
+    assert looks_binary(b"\xff\xfe\x00h\x00i") is True
+    assert looks_binary(b"hello world") is False
+    assert looks_binary("€".encode("utf-8") * 1000) is False
+
+
+def test_captures_by_content_type():
+    assert capture_body(b'{"a": 1}', "application/json") == '{"a": 1}'
+    assert capture_body(PNG, "image/png") == f"<binary {len(PNG)} bytes>"
+    assert capture_body(b"hello", "image/png") == "<binary 5 bytes>"
+    assert capture_body(PNG) == f"<binary {len(PNG)} bytes>"
+    assert capture_body(b"hello") == "hello"
+    assert capture_body(b"hello", "text/plain", 4) == "hell"
+    assert capture_body(b"\x1f\x8b\x08", "text/html", None, "gzip") == (
+        "<binary 3 bytes>"
+    )
+    assert capture_body(b"hello", "text/html", None, "identity") == "hello"
+    assert capture_body(b"", "image/png") == ""
+    assert capture_body("already text", "image/png") == "already text"
+    assert capture_body(None, "text/plain") is None
+
+
+def test_honors_charset():
+    assert charset("text/plain; charset=ISO-8859-1") == "iso8859-1"
+    assert charset("text/plain; charset=bogus") == "utf-8"
+    assert charset(None) == "utf-8"
+    body = "café".encode("latin-1")
+    assert capture_body(body, "text/plain; charset=latin-1") == "café"
+    assert capture_body(body, "text/plain") == f"<binary {len(body)} bytes>"
+
+
+def test_finds_headers_regardless_of_case():
+    assert header_value({"Content-Type": "text/plain"}, "content-type") == "text/plain"
+    assert header_value([("content-type", "a/b")], "Content-Type") == "a/b"
+    assert header_value(None, "content-type") is None
+    assert header_value({}, "content-type") is None
@@ -0,0 +1,49 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+import time
+
+from usagelogger import CircuitBreaker
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow() is True
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow() is False
+
+
+def test_probes_after_reset_timeout():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    assert breaker.allow() is False
+    time.sleep(0.02)
+    assert breaker.allow() is True
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow() is False
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.02)
+    assert breaker.allow() is True
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() is True
+
+
+def test_records_only_collector_faults_as_failures():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    for status in [204, 400, 413]:
+        breaker.record(status)
+        assert breaker.state == CircuitBreaker.CLOSED
+    for status in [None, 429, 503]:
+        breaker.record_success()
+        breaker.record(status)
+        assert breaker.state == CircuitBreaker.OPEN
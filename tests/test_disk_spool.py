@@ -0,0 +1,87 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+from usagelogger import DiskSpool
+
+
+def test_creates_empty_spool(tmp_path):
+    spool = DiskSpool(tmp_path / "spool")
+    assert spool.empty is True
+    assert spool.bytes == 0
+    assert spool.peek(10, 1000) == ([], 0)
+
+
+def test_replays_messages_in_order(tmp_path):
+    spool = DiskSpool(tmp_path)
+    assert spool.append(["a1", "a2"]) is True
+    assert spool.append(["b1"]) is True
+    assert spool.bytes == 9
+
+    messages, size = spool.peek(2, 1000)
+    assert messages == ["a1", "a2"]
+    assert spool.peek(2, 1000) == (messages, size)
+    spool.commit(size)
+    assert spool.peek(10, 1000) == (["b1"], 3)
+    spool.commit(3)
+    assert spool.empty is True
+    assert spool.peek(10, 1000) == ([], 0)
+
+
+def test_limits_peek_by_bytes(tmp_path):
+    spool = DiskSpool(tmp_path)
+    spool.append(["aaaa", "bbbb", "cccc"])
+    assert spool.peek(10, 6) == (["aaaa", "bbbb"], 10)
+
+
+def test_rotates_segments(tmp_path):
+    spool = DiskSpool(tmp_path, segment_bytes=5)
+    for i in range(5):
+        spool.append([f"msg{i}"])
+    assert len(list(tmp_path.glob("segment-*.ndjson"))) == 5
+
+    messages, size = spool.peek(3, 1000)
+    assert messages == ["msg0", "msg1", "msg2"]
+    spool.commit(size)
+    assert len(list(tmp_path.glob("segment-*.ndjson"))) == 2
+    assert spool.peek(10, 1000)[0] == ["msg3", "msg4"]
+
+
+def test_enforces_size_cap(tmp_path):
+    spool = DiskSpool(tmp_path, max_bytes=10)
+    assert spool.append(["12345678"]) is True
+    assert spool.append(["1"]) is False
+    assert spool.bytes == 9
+
+
+def test_survives_restart(tmp_path):
+    spool = DiskSpool(tmp_path, fsync="always")
+    spool.append(["a", "b", "c"])
+    spool.commit(spool.peek(1, 1000)[1])
+    spool.close()
+
+    spool = DiskSpool(tmp_path)
+    assert spool.bytes == 4
+    assert spool.peek(10, 1000) == (["b", "c"], 4)
+
+
+def test_rejects_invalid_fsync_policy(tmp_path):
+    try:
+        DiskSpool(tmp_path, fsync="sometimes")
+        assert False is True
+    except ValueError as e:
+        assert str(e) == "Invalid fsync policy: sometimes"
+
+
+def test_recovers_from_partial_and_corrupt_lines(tmp_path):
+    spool = DiskSpool(tmp_path)
+    spool.append(["a"])
+    spool.close()
+    with open(tmp_path / "segment-00000000.ndjson", "ab") as f:
+        f.write(b"\xff\xfe\n" + b'["half\xe2')  # undecodable, then cut off by a crash
+
+    spool = DiskSpool(tmp_path)
+    spool.append(["b"])
+    messages, size = spool.peek(10, 1000)
+    assert messages == ["a", "b"]
+    spool.commit(size)
+    assert spool.empty is True
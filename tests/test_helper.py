@@ -2,8 +2,9 @@
 # © 2016-2024 Graylog, Inc.
 
 import json
+import zlib
 
-from usagelogger import HttpRequestImpl, HttpResponseImpl
+from usagelogger import HttpLogger, HttpRequestImpl, HttpResponseImpl
 
 DEMO_URL = "https://demo.resurface.io"
 
@@ -51,6 +52,33 @@ MOCK_USER_AGENT = (
 )
 
 
+class MockResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = {} if headers is None else headers
+
+
+class MockSession:
+    """Stands in for requests.Session, recording each POST made by a logger."""
+
+    def __init__(self, status_code=204, statuses=None):
+        self.status_code = status_code
+        self.statuses = [] if statuses is None else list(statuses)
+        self.posts = []
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        data = bytes(data)
+        body = data
+        if headers.get("Content-Encoding") == "deflated":
+            body = zlib.decompress(data)
+        elif headers.get("Content-Encoding") == "gzip":
+            body = zlib.decompress(data, 31)
+        self.posts.append({"url": url, "data": data, "body": body, "headers": headers})
+        if self.statuses:
+            return MockResponse(self.statuses.pop(0))
+        return MockResponse(self.status_code)
+
+
 def mock_request():
     r = HttpRequestImpl()
     r.method = "GET"
@@ -89,6 +117,18 @@ def mock_response_with_html():
     return r
 
 
+def middleware_with_queue(middleware_class, app, rules="include debug"):
+    """Wraps app in a middleware whose logger writes messages to a list."""
+    queue = []
+    middleware = middleware_class(app)
+    middleware.logger = HttpLogger(queue=queue, rules=rules)
+    return middleware, queue
+
+
+def details(msg):
+    return dict(json.loads(msg))
+
+
 def parseable(msg):
     if (
         (msg is None)
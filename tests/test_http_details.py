@@ -0,0 +1,64 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+import json
+
+from usagelogger import HttpDetails, HttpRules
+from usagelogger.http_details import DetailKind
+
+DETAILS = [
+    ["request_method", "GET"],
+    ["request_url", "http://localhost/?a=1"],
+    ["request_header:user-agent", 'say "hi"'],
+    ["request_header: x-forwarded-for ", "10.0.0.1"],
+    ["request_param:a", "1"],
+    ["response_header:content-type", "text/plain; charset=ü"],
+    ["response_body", "line1\nline2\t €"],
+    ["session_field:x", "{}"],
+    ["custom", "value"],
+    ["now", "1455908640173"],
+]
+
+
+def test_reads_like_list_of_details():
+    details = HttpDetails.of(DETAILS)
+    assert len(details) == len(DETAILS)
+    assert details == DETAILS
+    assert details.to_list() == DETAILS
+    assert list(details)[2] == ("request_header:user-agent", 'say "hi"')
+    assert details[4] == ("request_param:a", "1")
+    assert details.kinds[2] == DetailKind.REQUEST_HEADER
+    assert details.names[2] == "user-agent"
+    assert details.kinds[8] == DetailKind.OTHER
+    assert details.key(8) == "custom"
+
+
+def test_serializes_like_json_module():
+    details = HttpDetails()
+    details.add(DetailKind.REQUEST_URL, "http://localhost")
+    details.add(DetailKind.REQUEST_HEADER, "a\\b", "x-a")
+    details.add(DetailKind.INTERVAL, 1.5)  # type: ignore
+    details.extend(DETAILS)
+    assert details.to_json() == json.dumps(details.to_list(), separators=(",", ":"))
+    assert HttpDetails().to_json() == "[]"
+
+
+def test_redacts_in_place():
+    details = HttpDetails.of(DETAILS)
+    values = details.values
+    rules = HttpRules(
+        "/request_header:.*/ remove\n/response_body/ replace /line/, /x/\n"
+        "/custom/ replace /.*/, //"
+    )
+    assert rules.apply(details) is details
+    assert details.values is values
+    assert details.to_list() == [
+        ["request_method", "GET"],
+        ["request_url", "http://localhost/?a=1"],
+        ["request_param:a", "1"],
+        ["response_header:content-type", "text/plain; charset=ü"],
+        ["response_body", "x1\nx2\t €"],
+        ["session_field:x", "{}"],
+        ["now", "1455908640173"],
+    ]
+    assert HttpRules("/request_url/ stop").apply(HttpDetails.of(DETAILS)) is None
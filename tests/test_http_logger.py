@@ -105,3 +105,43 @@ def test_silently_ignores_unexpected_option_classes():
     assert logger.enabled is False
     assert logger.queue is None
     assert logger.url is None
+
+
+def test_prechecks_requests():
+    queue = []
+    logger = HttpLogger(queue=queue, rules="!request_url! stop_if_found !/health!")
+    assert logger.rules.stops_early is True
+    assert logger.precheck("GET", "http://localhost/health", {}) is False
+    assert logger.precheck("GET", "http://localhost/api", {}) is True
+
+    logger = HttpLogger(
+        queue=queue, rules="!request_header:user-agent! stop_if !.*bot.*!"
+    )
+    assert logger.precheck("GET", "http://localhost", {"User-Agent": "my bot"}) is False
+    assert logger.precheck("GET", "http://localhost", {"User-Agent": "Firefox"}) is True
+    assert logger.precheck("GET", "http://localhost", [("User-Agent", "bot")]) is False
+
+    logger = HttpLogger(queue=queue, rules="!request_param:debug! stop")
+    assert logger.precheck("GET", "http://localhost/?debug=1", {}) is False
+    assert logger.precheck("GET", "http://localhost/?verbose=1", {}) is True
+
+    logger = HttpLogger(queue=queue, rules="!request_method! stop_if !OPTIONS!")
+    assert logger.precheck("OPTIONS", "http://localhost", None) is False
+    assert logger.precheck("GET", "http://localhost", None) is True
+
+
+def test_prechecks_only_rules_decidable_early():
+    queue = []
+    for rules in [
+        "!response_body! stop",
+        "!request_url! stop_unless !.*/api.*!",
+        "!request_url! stop_unless_found !/api!",
+        "include debug",
+    ]:
+        logger = HttpLogger(queue=queue, rules=rules)
+        assert logger.precheck("GET", "http://localhost/health", {}) is True
+
+    logger = HttpLogger(queue=queue, rules="include debug")
+    assert logger.rules.stops_early is False
+    logger.disable()
+    assert logger.precheck("GET", "http://localhost/health", {}) is False
@@ -9,7 +9,7 @@ from tests.test_helper import (
     mock_request_with_json2,
     mock_response_with_html,
 )
-from usagelogger import HttpLogger, HttpMessage, HttpRules
+from usagelogger import AdaptiveSampler, HttpLogger, HttpMessage, HttpRules
 
 
 def test_overrides_default_rules():
@@ -593,6 +593,98 @@ def test_uses_sample_rules():
     assert 2 <= len(queue) <= 20
 
 
+def test_uses_rate_limit_rules():
+    queue = []
+    logger = HttpLogger(
+        queue=queue, rules="include debug\n/request_url/ rate_limit 2/h"
+    )
+    for _ in range(5):
+        HttpMessage.send(
+            logger,
+            request=mock_request_with_json2(),
+            response=mock_response_with_html(),
+        )
+    assert len(queue) == 2
+    url = mock_request_with_json2().url
+    assert logger.rate_limit_dropped == {f"request_url:{url}": 3}
+
+
+def test_rate_limits_only_messages_passing_stop_rules():
+    queue = []
+    logger = HttpLogger(
+        queue=queue,
+        rules="include debug\n/response_code/ stop_unless /200/\nrate_limit 1/m",
+    )
+    failed = mock_response_with_html()
+    failed.status = 500
+    HttpMessage.send(logger, request=mock_request_with_json2(), response=failed)
+    HttpMessage.send(
+        logger, request=mock_request_with_json2(), response=mock_response_with_html()
+    )
+    assert len(queue) == 1
+    assert logger.rate_limit_dropped == {}
+
+
+def test_samples_adaptively():
+    queue = []
+    sampler = AdaptiveSampler(latency_threshold=1.0, min_rate=10, interval=0)
+    logger = HttpLogger(queue=queue, rules="include debug", adaptive_sampler=sampler)
+    assert logger.sample_rate == 100
+    sampler.record_latency(5.0)
+    for _ in range(100):
+        HttpMessage.send(
+            logger,
+            request=mock_request_with_json2(),
+            response=mock_response_with_html(),
+        )
+    assert logger.sample_rate == 10
+    assert 3 <= len(queue) <= 30
+
+    for _ in range(10):
+        sampler.record_latency(0.01)
+    for _ in range(10):
+        HttpMessage.send(
+            logger,
+            request=mock_request_with_json2(),
+            response=mock_response_with_html(),
+        )
+    assert logger.sample_rate == 100
+
+    logger = HttpLogger(queue=queue, rules="sample 50", adaptive_sampler=sampler)
+    assert logger.sample_rate == 50
+    sampler.record_latency(50.0)
+    sampler.update(0)
+    assert logger.sample_rate == 25
+
+
+def test_samples_before_building(monkeypatch):
+    queue = []
+    logger = HttpLogger(
+        queue=queue,
+        rules="include debug\nsample 50\nsample_by /request_header:x-trace-id/\n"
+        "/response_code/ sample_if /5\\d\\d/ 100",
+    )
+    built = []
+    build = HttpMessage.build
+    monkeypatch.setattr(
+        HttpMessage, "build", lambda *a, **kw: built.append(1) or build(*a, **kw)
+    )
+    kept = []
+    for i in range(100):
+        request = mock_request_with_json2()
+        request.headers["X-Trace-Id"] = f"trace-{i}"
+        kept.append(logger.sampled("GET", "/", {"x-trace-id": f"trace-{i}"}))
+        HttpMessage.send(logger, request=request, response=mock_response_with_html())
+    assert len(queue) == len(built) == kept.count(True)
+    assert 20 <= len(queue) <= 80
+
+    response = mock_response_with_html()
+    response.status = 503
+    for _ in range(10):
+        HttpMessage.send(logger, request=mock_request_with_json2(), response=response)
+    assert len(queue) == kept.count(True) + 10
+
+
 def test_uses_skip_compression_rules():
     logger = HttpLogger(url="http://mysite.com")
     assert logger.skip_compression is False
@@ -15,6 +15,7 @@ from tests.test_helper import (
     mock_response_with_html,
     parseable,
 )
+from tests.test_multipart_decoder import UPLOAD
 from usagelogger import HttpLogger, HttpMessage, HttpRequestImpl, HttpResponseImpl
 
 
@@ -168,3 +169,50 @@ def test_formats_response_with_missing_details():
     assert "response_code" not in msg
     assert "response_header" not in msg
     assert "interval" not in msg
+
+
+def test_truncates_bodies():
+    queue = []
+    logger = HttpLogger(
+        queue=queue, rules="include debug\n/response_body|request_body/ truncate 10"
+    )
+    HttpMessage.send(
+        logger,
+        request=mock_request_with_json(),
+        response=mock_response_with_html(),
+        response_body=MOCK_HTML.encode("utf-8"),
+    )
+    assert len(queue) == 1
+    msg = queue[0]
+    assert parseable(msg) is True
+    assert f'["response_body","{MOCK_HTML[:10]}"]' in msg
+    assert '["request_body","{ \\"hello\\" "]' in msg
+
+
+def test_skips_binary_bodies():
+    queue = []
+    logger = HttpLogger(queue=queue, rules="include debug")
+    response = mock_response()
+    response.headers["Content-Type"] = "image/png"
+    HttpMessage.send(
+        logger,
+        request=mock_request(),
+        response=response,
+        response_body=b"\x89PNG\r\n\x1a\n\x00\x00",
+    )
+    assert len(queue) == 1
+    assert '["response_body","<binary 10 bytes>"]' in queue[0]
+
+
+def test_decodes_byte_bodies_as_built():
+    request = mock_request()
+    request.headers["Content-Type"] = "multipart/form-data; boundary=xyz"
+    request.body = UPLOAD
+    response = mock_response()
+    response.headers["Content-Type"] = "image/png"
+    response.body, response.body_size = b"\x89PNG", 1000
+    msg = HttpMessage.build(request, response)
+    details = dict(msg)
+    assert "<file-data 10 bytes>" in details["request_body"]
+    assert "w\u00f6rld" in details["request_body"]
+    assert details["response_body"] == "<binary 1000 bytes>"
@@ -797,6 +797,166 @@ def test_parses_sample_rules():
     parse_ok("sample 50", "sample", None, 50, None)
     parse_ok("sample 72 # comment", "sample", None, 72, None)
 
+    parse_fail("sample_by")
+    parse_fail("sample_by 50")
+    parse_ok(
+        "sample_by /request_header:x-trace-id/",
+        "sample_by",
+        None,
+        "^request_header:x-trace-id$",
+        None,
+    )
+
+    parse_fail("/response_code/ sample_if /500/")
+    parse_fail("/response_code/ sample_if /500/ 0")
+    parse_fail("/response_code/ sample_if /500/ 101")
+    parse_fail("sample_if /500/ 50")
+    parse_ok(
+        "/response_code/ sample_if /5.*/ 100 # errors",
+        "sample_if",
+        "^response_code$",
+        "^5.*$",
+        100,
+    )
+
+
+def test_parses_rate_limit_rules():
+    parse_fail("rate_limit")
+    parse_fail("rate_limit 10")
+    parse_fail("rate_limit 10/d")
+    parse_fail("rate_limit 0/s")
+    parse_fail("rate_limit /request_url/ 10/s")
+    parse_ok("rate_limit 10/s", "rate_limit", None, 10.0, 10.0)
+    parse_ok("rate_limit 2.5/s # comment", "rate_limit", None, 2.5, 2.5)
+    parse_ok("rate_limit 60/m", "rate_limit", None, 1.0, 60.0)
+    parse_ok("/request_url/ rate_limit 36/h", "rate_limit", "^request_url$", 0.01, 36.0)
+
+
+def test_rate_limits_by_scope():
+    rules = HttpRules("include debug\n/request_url/ rate_limit 3/h\nrate_limit 10/h")
+    assert len(rules.rate_limit) == 2
+    login = [["request_url", "/login"], ["response_code", "401"]]
+    users = [["request_url", "/users"], ["response_code", "200"]]
+    assert [rules.apply([d[:] for d in login]) is None for _ in range(5)] == [
+        False,
+        False,
+        False,
+        True,
+        True,
+    ]
+    assert rules.rate_limited(users) is False
+    assert rules.rate_limit_dropped == {"request_url:/login": 2}
+
+    # unscoped limit is shared by all messages, including those not in scope
+    assert sum(rules.rate_limited([["response_code", "200"]]) for _ in range(10)) == 4
+    assert rules.rate_limit_dropped == {"request_url:/login": 2, "*": 4}
+
+
+def test_rate_limits_below_one_per_second(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("time.monotonic", lambda: now[0])
+    rules = HttpRules("rate_limit 0.5/s")
+    limited = []
+    for _ in range(3):
+        limited.append(rules.rate_limited([["response_code", "200"]]))
+        now[0] += 1.1
+    assert limited == [False, True, False]
+    assert rules.rate_limit_dropped == {"*": 1}
+
+
+def test_bounds_rate_limit_buckets():
+    rules = HttpRules("/request_url/ rate_limit 1/h", cache_size=10)
+    for i in range(100):
+        assert rules.rate_limited([["request_url", f"/{i}"]]) is False
+        assert rules.rate_limited([["request_url", f"/{i}"]]) is True
+    assert len(rules.rate_limit_dropped) == 10
+
+
+def test_parses_truncate_rules():
+    parse_fail("truncate 64k")
+    parse_fail("/response_body/ truncate")
+    parse_fail("/response_body/ truncate 0")
+    parse_fail("/response_body/ truncate 64g")
+    parse_fail("/response_body/ truncate /64k/")
+    parse_ok("/response_body/ truncate 100", "truncate", "^response_body$", 100, None)
+    parse_ok(
+        "/request_body/ truncate 64k # x", "truncate", "^request_body$", 65536, None
+    )
+    parse_ok(
+        "/response_body/ truncate 2M", "truncate", "^response_body$", 2097152, None
+    )
+
+
+def test_truncates_before_other_rules():
+    rules = HttpRules(
+        "/request_body|response_body/ truncate 8\n/response_body/ truncate 6\n"
+        "/response_body/ stop_if_found /secret/\n/request_body/ replace /abc/, /x/"
+    )
+    assert len(rules.truncate) == 2
+    assert rules.truncation("request_body") == 8
+    assert rules.truncation("response_body") == 6
+    assert rules.truncation("request_url") is None
+    assert HttpRules("include debug").truncation("response_body") is None
+    details = rules.apply(
+        [
+            ["request_url", "/abcdefghijk"],
+            ["request_body", "abcdefghijk"],
+            ["response_body", "hello secret"],
+        ]
+    )
+    assert details == [
+        ["request_url", "/abcdefghijk"],
+        ["request_body", "xdefgh"],
+        ["response_body", "hello "],
+    ]
+    details = rules.apply([["response_body", "€€€"]])
+    assert details == [["response_body", "€€"]]
+
+
+def test_samples_by_hashed_key():
+    rules = HttpRules("sample 50\nsample_by /request_header:x-trace-id/")
+    assert rules.samples is True
+    assert len(rules.sample_by) == 1
+    kept = [
+        rules.sampled([["request_header:x-trace-id", f"trace-{i}"]]) for i in range(200)
+    ]
+    assert 50 <= kept.count(True) <= 150
+    for i in range(200):
+        details = [["request_url", "/"], ["request_header:x-trace-id", f"trace-{i}"]]
+        assert rules.sampled(details) is kept[i]
+        assert (rules.apply(details) is not None) is kept[i]
+
+
+def test_samples_by_first_rule_found():
+    rules = HttpRules(
+        "sample 1\nsample_by /request_header:x-trace-id/\nsample_by /request_url/"
+    )
+    kept = [rules.sampled([["request_url", f"/{i}"]]) for i in range(100)]
+    assert kept.count(True) < 10
+    for i in range(100):
+        details = [["request_url", f"/{i}"], ["request_header:x-trace-id", "abc"]]
+        assert rules.sampled(details) is rules.sampled(details[1:])
+
+
+def test_samples_per_scope():
+    rules = HttpRules(
+        "sample 50\n/response_code/ sample_if /5\\d\\d/ 100\n"
+        "/request_url/ sample_if /.*health.*/ 1\nsample_by /request_url/"
+    )
+    assert len(rules.sample_if) == 2
+    errors = [
+        [["request_url", f"/health{i}"], ["response_code", "503"]] for i in range(100)
+    ]
+    assert all(rules.sampled(d) for d in errors)
+    health = [
+        [["request_url", f"/health{i}"], ["response_code", "200"]] for i in range(100)
+    ]
+    assert sum(rules.sampled(d) for d in health) < 10
+
+    rules = HttpRules("/request_url/ sample_if /.*health.*/ 1")
+    assert rules.samples is True
+    assert rules.sampled([["request_url", "/users"]]) is True
+
 
 def test_parses_skip_compression_rules():
     parse_fail("skip_compression whaa")
@@ -1247,3 +1407,65 @@ def test_raises_expected_errors():
         assert False
     except SyntaxError as e:
         assert str(e) == "Unescaped separator (!) in rule: !!! stop"
+
+
+def test_applies_rules_in_order():
+    rules = HttpRules(
+        "/request_body/ replace /a/, /b/\n"
+        "/request_.*/ replace /b/, /c/\n"
+        "/request_body/ replace /c/, /d/\n"
+        "/request_header:.*/ remove_if /secret/\n"
+        "/request_header:.*/ remove_unless_found /keep/\n"
+    )
+    details = [
+        ["request_body", "aaa"],
+        ["request_url", "abc"],
+        ["request_header:a", "secret"],
+        ["request_header:b", "keep me"],
+        ["request_header:c", "drop me"],
+        ["response_body", ""],
+    ]
+    assert rules.apply(details) == [
+        ["request_body", "ddd"],
+        ["request_url", "acc"],
+        ["request_header:b", "keep me"],
+    ]
+
+
+def test_applies_stop_rules_before_remove_rules():
+    rules = HttpRules("/request_body/ remove\n/request_body/ stop_if_found /x/")
+    assert rules.apply([["request_body", "x"], ["request_url", "y"]]) is None
+    assert rules.apply([["request_body", "z"], ["request_url", "y"]]) == [
+        ["request_url", "y"]
+    ]
+
+    rules = HttpRules("/request_url/ stop_unless /y/\n/request_url/ remove")
+    assert rules.apply([["request_url", "y"], ["request_body", "z"]]) == [
+        ["request_body", "z"]
+    ]
+    assert rules.apply([["request_url", "n"], ["request_body", "z"]]) is None
+
+
+def test_applies_replace_rules_to_empty_results():
+    rules = HttpRules("/request_body/ replace /.*/, //")
+    assert rules.apply([["request_body", "abc"], ["request_url", "y"]]) == [
+        ["request_url", "y"]
+    ]
+    assert rules.apply([["request_body", "abc"]]) is None
+
+
+def test_caches_plans_by_detail_key():
+    rules = HttpRules("/request_header:.*/ remove_if /secret/", cache_size=2)
+    details = [["request_header:a", "secret"], ["request_header:b", "public"]]
+    assert rules.apply([list(d) for d in details]) == [["request_header:b", "public"]]
+    assert rules.cache_info.hits == 0
+    assert rules.cache_info.misses == 2
+
+    assert rules.apply([list(d) for d in details]) == [["request_header:b", "public"]]
+    assert rules.cache_info.hits == 2
+    assert rules.cache_info.misses == 2
+
+    rules.apply([["request_header:c", "secret"]])
+    assert rules.cache_info.misses == 3
+    assert rules.cache_info.currsize == 2
+    assert rules.cache_info.maxsize == 2
@@ -0,0 +1,154 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+import asyncio
+import json
+
+from usagelogger import AsyncHttpLogger
+from usagelogger.middleware.asgi import HttpLoggerForASGI
+
+
+async def streaming_app(scope, receive, send):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 201,
+            "headers": [(b"content-type", b"text/plain"), (b"x-a", b"1")],
+        }
+    )
+    for chunk in [b"echo:", body, b":done"]:
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+def run(middleware, scope, chunks):
+    received = list(chunks)
+    sent = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    async def main():
+        await middleware(scope, receive, send)
+        await middleware.logger.aflush()
+
+    asyncio.run(main())
+    return sent
+
+
+def http_scope(**kwargs):
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/echo",
+        "raw_path": b"/echo",
+        "query_string": b"a=1&b=2",
+        "headers": [
+            (b"host", b"example.com"),
+            (b"content-type", b"text/plain"),
+            (b"x-list", b"1"),
+            (b"x-list", b"2"),
+        ],
+        "client": ("10.0.0.1", 12345),
+        "server": ("example.com", 80),
+    }
+    scope.update(kwargs)
+    return scope
+
+
+def test_logs_streamed_exchange():
+    queue = []
+    middleware = HttpLoggerForASGI(streaming_app)
+    middleware.logger = AsyncHttpLogger(queue=queue, rules="include debug")
+    sent = run(
+        middleware,
+        http_scope(),
+        [
+            {"type": "http.request", "body": b"hel", "more_body": True},
+            {"type": "http.request", "body": b"lo"},
+        ],
+    )
+    assert [m.get("body") for m in sent[1:]] == [b"echo:", b"hello", b":done", b""]
+    assert len(queue) == 1
+    details = dict(json.loads(queue[0]))
+    assert details["request_method"] == "POST"
+    assert details["request_url"] == "http://example.com/echo?a=1&b=2"
+    assert details["request_param:a"] == "1"
+    assert details["request_header:x-list"] == "1, 2"
+    assert details["request_body"] == "hello"
+    assert details["response_code"] == "201"
+    assert details["response_header:x-a"] == "1"
+    assert details["response_body"] == "echo:hello:done"
+
+
+def test_bounds_captured_bodies():
+    queue = []
+    middleware = HttpLoggerForASGI(streaming_app)
+    middleware.logger = AsyncHttpLogger(
+        queue=queue, rules="include debug\n/request_body|response_body/ truncate 7"
+    )
+    run(middleware, http_scope(), [{"type": "http.request", "body": b"x" * 100}])
+    details = dict(json.loads(queue[0]))
+    assert details["request_body"] == "x" * 7
+    assert details["response_body"] == "echo:xx"
+
+
+def test_sizes_binary_bodies_past_the_captured_bytes():
+    queue = []
+    middleware = HttpLoggerForASGI(streaming_app)
+    middleware.logger = AsyncHttpLogger(
+        queue=queue, rules="include debug\n/request_body/ truncate 50"
+    )
+    scope = http_scope(headers=[(b"content-type", b"application/octet-stream")])
+    run(middleware, scope, [{"type": "http.request", "body": b"\x00" * 100}])
+    details = dict(json.loads(queue[0]))
+    assert details["request_body"] == "<binary 100 bytes>"
+
+
+def test_passes_through_other_scopes():
+    queue = []
+    calls = []
+
+    async def app(scope, receive, send):
+        calls.append(scope["type"])
+
+    middleware = HttpLoggerForASGI(app)
+    middleware.logger = AsyncHttpLogger(queue=queue, rules="include debug")
+    run(middleware, {"type": "lifespan"}, [])
+    middleware.logger = AsyncHttpLogger(queue=queue, rules="/request_url/ stop")
+    run(middleware, http_scope(), [])
+    assert calls == ["lifespan", "http"]
+    assert queue == []
+
+
+def test_decodes_uploads_as_they_stream():
+    queue = []
+    middleware = HttpLoggerForASGI(streaming_app)
+    middleware.logger = AsyncHttpLogger(queue=queue, rules="include debug")
+    chunks = [
+        b'--b\r\nContent-Disposition: form-data; name="f"; filename="a"\r\n\r\n',
+        b"\x00" * 5000,
+        b"\r\n--b--\r\n",
+    ]
+    scope = http_scope(headers=[(b"content-type", b"multipart/form-data; boundary=b")])
+    run(
+        middleware,
+        scope,
+        [{"type": "http.request", "body": c, "more_body": True} for c in chunks]
+        + [{"type": "http.request", "body": b""}],
+    )
+    details = dict(json.loads(queue[0]))
+    assert details["request_body"] == (
+        '--b\r\nContent-Disposition: form-data; name="f"; filename="a"\r\n\r\n'
+        "<file-data 5000 bytes>\r\n--b--\r\n"
+    )
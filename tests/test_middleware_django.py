@@ -0,0 +1,67 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+import asyncio
+import time
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        ALLOWED_HOSTS=["testserver"],
+        USAGELOGGER={"url": None, "rules": "include debug"},
+    )
+    django.setup()
+
+from django.http import HttpResponse  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+
+from tests.test_helper import details, middleware_with_queue  # noqa: E402
+from usagelogger.middleware.django import HttpLoggerForDjango  # noqa: E402
+
+
+def view(request):
+    return HttpResponse("hello", content_type="text/plain", status=201)
+
+
+async def async_view(request):
+    return view(request)
+
+
+def test_logs_sync_requests():
+    middleware, queue = middleware_with_queue(HttpLoggerForDjango, view)
+    assert not asyncio.iscoroutinefunction(middleware)
+    response = middleware(RequestFactory().get("/echo?a=1"))
+    assert response.status_code == 201
+    assert len(queue) == 1
+    d = details(queue[0])
+    assert d["request_method"] == "GET"
+    assert d["request_url"] == "http://testserver/echo?a=1"
+    assert d["response_code"] == "201"
+    assert d["response_body"] == "hello"
+
+
+def test_logs_async_requests():
+    middleware, queue = middleware_with_queue(HttpLoggerForDjango, async_view)
+    assert asyncio.iscoroutinefunction(middleware)
+    response = asyncio.run(
+        middleware(RequestFactory().post("/echo", "ping", content_type="text/plain"))
+    )
+    assert response.status_code == 201
+    assert len(queue) == 1
+    d = details(queue[0])
+    assert d["request_method"] == "POST"
+    assert d["request_body"] == "ping"
+    assert d["response_body"] == "hello"
+
+
+def test_stamps_deferred_messages_with_request_time():
+    middleware, queue = middleware_with_queue(HttpLoggerForDjango, view)
+    builders = []
+    middleware.logger.submit_deferred = lambda build, size: builders.append(build)
+    middleware(RequestFactory().get("/echo"))
+    ended = round(time.time() * 1000)
+    time.sleep(0.1)
+    msg = builders[0]()
+    assert ended - 50 <= int(dict(msg)["now"]) <= ended
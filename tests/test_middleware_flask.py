@@ -0,0 +1,91 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+import threading
+
+from werkzeug.test import Client
+
+from tests.test_helper import details, middleware_with_queue
+from usagelogger.middleware.flask import HttpLoggerForFlask
+
+
+def test_streams_chunks_lazily_and_logs_on_close():
+    produced = []
+
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        for chunk in [b"one,", b"two,", b"three"]:
+            produced.append(chunk)
+            yield chunk
+
+    middleware, queue = middleware_with_queue(HttpLoggerForFlask, app)
+    response = Client(middleware).get("/stream", buffered=False)
+    chunks = iter(response.response)
+    assert next(chunks) == b"one,"
+    assert produced == [b"one,"]
+    assert b"".join(chunks) == b"two,three"
+    assert queue == []
+    response.close()
+    assert len(queue) == 1
+    d = details(queue[0])
+    assert d["response_code"] == "200"
+    assert d["response_body"] == "one,two,three"
+
+
+def test_keeps_state_per_request():
+    started = threading.Event()
+    release = threading.Event()
+
+    def app(environ, start_response):
+        if environ["PATH_INFO"] == "/slow":
+            start_response("500 Internal Server Error", [])
+            started.set()
+            release.wait(5)
+            return [b"slow"]
+        start_response("201 Created", [])
+        return [b"fast"]
+
+    middleware, queue = middleware_with_queue(HttpLoggerForFlask, app)
+    slow = threading.Thread(target=lambda: Client(middleware).get("/slow").close())
+    slow.start()
+    started.wait(5)
+    Client(middleware).get("/fast").close()
+    release.set()
+    slow.join(5)
+
+    logged = {details(m)["request_url"]: details(m) for m in queue}
+    fast, slow = logged["http://localhost/fast"], logged["http://localhost/slow"]
+    assert fast["response_code"] == "201"
+    assert slow["response_code"] == "500"
+    assert float(fast["interval"]) < float(slow["interval"])
+
+
+def test_bounds_response_capture():
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return (b"x" * 1024 for _ in range(100))
+
+    middleware, queue = middleware_with_queue(
+        HttpLoggerForFlask, app, "include debug\n/response_body/ truncate 10"
+    )
+    response = Client(middleware).get("/big")
+    assert len(response.data) == 100 * 1024
+    response.close()
+    assert details(queue[0])["response_body"] == "x" * 10
+
+
+def test_restores_request_body_of_unknown_length():
+    def app(environ, start_response):
+        start_response("200 OK", [])
+        return [environ["wsgi.input"].read()]
+
+    middleware, queue = middleware_with_queue(HttpLoggerForFlask, app)
+    response = Client(middleware).post(
+        "/echo",
+        data=b"ping",
+        content_type="text/plain",
+        environ_overrides={"CONTENT_LENGTH": "-1"},
+    )
+    assert response.data == b"ping"
+    response.close()
+    assert details(queue[0])["request_body"] == "ping"
@@ -0,0 +1,66 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+from usagelogger.utils.multipart_decoder import (
+    MultipartDecoder,
+    decode_multipart,
+    multipart_boundary,
+)
+
+UPLOAD = (
+    b"--xyz\r\n"
+    b'Content-Disposition: form-data; name="a"\r\n\r\n'
+    b"hello\r\n"
+    b"--xyz\r\n"
+    b'Content-Disposition: form-data; name="f"; filename="x.png"\r\n'
+    b"Content-Type: image/png\r\n\r\n"
+    b"\x89PNG\x00\r\n--x\r\n"
+    b"--xyz\r\n"
+    b'Content-Disposition: form-data; name="b"\r\n\r\n'
+    b"w\xc3\xb6rld\r\n"
+    b"--xyz--\r\n"
+)
+
+DECODED = (
+    "--xyz\r\n"
+    'Content-Disposition: form-data; name="a"\r\n\r\n'
+    "hello\r\n"
+    "--xyz\r\n"
+    'Content-Disposition: form-data; name="f"; filename="x.png"\r\n'
+    "Content-Type: image/png\r\n\r\n"
+    "<file-data 10 bytes>\r\n"
+    "--xyz\r\n"
+    'Content-Disposition: form-data; name="b"\r\n\r\n'
+    "wörld\r\n"
+    "--xyz--\r\n"
+)
+
+
+def test_replaces_file_parts():
+    assert multipart_boundary("multipart/form-data; boundary=xyz") == "xyz"
+    assert multipart_boundary('multipart/form-data; boundary="x y"') == "x y"
+    assert multipart_boundary("multipart/form-data") is None
+    assert decode_multipart(UPLOAD, "multipart/form-data; boundary=xyz") == DECODED
+    assert decode_multipart(memoryview(UPLOAD)) == DECODED
+    assert decode_multipart(b"not multipart") == "<binary 13 bytes>"
+    assert decode_multipart(None) is None
+
+
+def test_decodes_in_chunks():
+    for n in [1, 2, 3, 7, 64]:
+        decoder = MultipartDecoder()
+        for i in range(0, len(UPLOAD), n):
+            decoder.write(UPLOAD[i : i + n])
+        assert decoder.getvalue() == DECODED
+        assert decoder.size == len(UPLOAD)
+
+
+def test_keeps_only_text_fields():
+    decoder = MultipartDecoder("xyz")
+    decoder.write(UPLOAD[:152])
+    for _ in range(1000):
+        decoder.write(b"\x00" * 10000)
+    decoder.write(UPLOAD[152:])
+    assert "<file-data 10000010 bytes>" in decoder.getvalue()
+    assert len(decoder._out) == len(DECODED.encode("utf-8")) + 6
+    assert decode_multipart(UPLOAD, None, 60) == DECODED[:60]
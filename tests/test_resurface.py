@@ -0,0 +1,49 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from usagelogger import HttpLogger
+from usagelogger.resurface import ResurfaceHTTPAdapter, Session
+from usagelogger.utils._adapter import MiddlewareHTTPAdapter
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        delay = int(self.path.strip("/"))
+        time.sleep(delay / 1000)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.end_headers()
+        self.wfile.write(str(delay).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def test_times_concurrent_requests():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        queue = []
+        middleware = ResurfaceHTTPAdapter()
+        middleware.logger = HttpLogger(queue=queue, rules="include debug")
+        session = Session()
+        session.mount("http://", MiddlewareHTTPAdapter([middleware]))
+        port = server.server_address[1]
+        delays = [20, 300, 20, 300, 20, 300]
+        with ThreadPoolExecutor(len(delays)) as pool:
+            list(
+                pool.map(lambda d: session.get(f"http://127.0.0.1:{port}/{d}"), delays)
+            )
+    finally:
+        server.shutdown()
+    assert len(queue) == len(delays)
+    for msg in queue:
+        details = dict(json.loads(msg))
+        delay = int(details["response_body"])
+        assert delay <= float(details["interval"]) < delay + 200
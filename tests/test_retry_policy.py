@@ -0,0 +1,36 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+from usagelogger import RetryPolicy
+
+
+def test_retries_expected_statuses():
+    policy = RetryPolicy()
+    assert policy.retryable(None) is True
+    for status in [408, 429, 500, 502, 503, 504]:
+        assert policy.retryable(status) is True
+    for status in [200, 204, 400, 401, 404, 413]:
+        assert policy.retryable(status) is False
+
+    policy = RetryPolicy(retryable_statuses=[418])
+    assert policy.retryable(418) is True
+    assert policy.retryable(503) is False
+
+
+def test_backs_off_exponentially():
+    policy = RetryPolicy(backoff=1.0, multiplier=2.0, max_backoff=5.0, jitter=0.0)
+    assert [policy.delay(a) for a in range(1, 6)] == [1.0, 2.0, 4.0, 5.0, 5.0]
+
+
+def test_adds_jitter():
+    policy = RetryPolicy(backoff=1.0, jitter=0.5)
+    delays = [policy.delay(2) for _ in range(100)]
+    assert all(1.0 <= d <= 2.0 for d in delays)
+    assert len(set(delays)) > 1
+
+
+def test_honors_retry_after():
+    policy = RetryPolicy(backoff=1.0, max_backoff=10.0, jitter=0.0)
+    assert policy.delay(1, retry_after=3) == 3
+    assert policy.delay(1, retry_after=0.5) == 1.0
+    assert policy.delay(1, retry_after=60) == 10.0
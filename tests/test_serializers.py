@@ -0,0 +1,105 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+import json
+import zlib
+
+import pytest
+
+from tests.test_helper import DEMO_URL, MOCK_AGENT
+from usagelogger import BaseLogger, HttpDetails, Serializer
+from usagelogger.base_logger import NdjsonBatch
+from usagelogger.serializers import (
+    SERIALIZERS,
+    DetailsSerializer,
+    JsonSerializer,
+    OrjsonSerializer,
+    available_serializers,
+    select_serializer,
+)
+
+DETAILS = [
+    ["request_url", "http://localhost/?a=1"],
+    ["request_header:user-agent", 'say "hi"'],
+    ["request_body", "line1\nline2\t €"],
+    ["now", "1455908640173"],
+]
+
+
+def test_selects_serializers(monkeypatch):
+    names = available_serializers()
+    assert names[-2:] == ["details", "json"]
+    assert list(SERIALIZERS)[0] == "orjson"
+    assert isinstance(select_serializer(), SERIALIZERS[names[0]])
+    assert isinstance(select_serializer("json"), JsonSerializer)
+    custom = DetailsSerializer()
+    assert select_serializer(custom) is custom
+    with pytest.raises(TypeError):
+        Serializer()  # dumps is abstract
+    with pytest.raises(ValueError):
+        select_serializer("yaml")
+    if not OrjsonSerializer.available:
+        with pytest.raises(ImportError):
+            select_serializer("orjson")
+
+    assert isinstance(BaseLogger(MOCK_AGENT, url=DEMO_URL).serializer, Serializer)
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, serializer="json")
+    assert isinstance(logger.serializer, JsonSerializer)
+    monkeypatch.setenv("USAGE_LOGGERS_SERIALIZER", "details")
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL)
+    assert isinstance(logger.serializer, DetailsSerializer)
+
+
+def test_dumps_like_json_module():
+    serializer = DetailsSerializer()
+    for msg in [DETAILS, [["a", 1]], ["ab"], [("a", "b")], {"a": "b"}]:
+        assert serializer.dumps(msg) == json.dumps(msg, separators=(",", ":"))
+    expected = json.dumps(DETAILS, separators=(",", ":"))
+    assert serializer.dumps(HttpDetails.of(DETAILS)) == expected
+    assert JsonSerializer().dumps(HttpDetails.of(DETAILS)) == expected
+
+
+@pytest.mark.parametrize("name", available_serializers())
+def test_encodes_to_utf8(name):
+    serializer = select_serializer(name)
+    for msg in [DETAILS, HttpDetails.of(DETAILS), [["a", 1]], [["b", "\ud800"]]]:
+        expected = [list(d) for d in msg]
+        assert json.loads(serializer.dumps(msg)) == expected
+        out = bytearray()
+        serializer.write(msg, out)
+        assert json.loads(out.decode("utf-8")) == expected
+    out = bytearray(b"x")
+    with pytest.raises(TypeError):
+        serializer.write([["now", object()]], out)
+    assert out == b"x"
+
+
+def test_writes_batches_into_buffer():
+    batch = NdjsonBatch(keep_messages=True)
+    batch.write(DETAILS)
+    with pytest.raises(TypeError):
+        batch.write([["now", object()]])
+    batch.append('[["now","1"]]')
+    value = batch.getvalue()
+    assert value is batch.buffer
+    assert value.split(b"\n")[1] == b'[["now","1"]]'
+    assert [json.loads(m) for m in batch.messages] == [DETAILS, [["now", "1"]]]
+    assert batch.count == 2
+    assert batch.size == len(value) + 1
+
+    batch = NdjsonBatch("deflate", serializer=JsonSerializer())
+    batch.write(DETAILS)
+    batch.write(HttpDetails.of(DETAILS))
+    lines = zlib.decompress(batch.getvalue()).split(b"\n")
+    assert lines == [json.dumps(DETAILS, separators=(",", ":")).encode("ascii")] * 2
+
+
+def test_compresses_batches_in_spans():
+    batch = NdjsonBatch("gzip")
+    line = [["request_body", "x" * 1000]]
+    for _ in range(100):
+        batch.write(line)
+        assert len(batch.buffer) < 65 * 1024
+    lines = zlib.decompress(batch.getvalue(), 31).split(b"\n")
+    assert lines == [json.dumps(line, separators=(",", ":")).encode("ascii")] * 100
+    assert batch.size == sum(len(x) + 1 for x in lines)
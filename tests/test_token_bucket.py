@@ -0,0 +1,45 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+import threading
+
+from usagelogger.token_bucket import TokenBucket
+
+
+def test_allows_bursts_up_to_capacity():
+    bucket = TokenBucket(5)
+    assert bucket.capacity == 5
+    assert [bucket.take() for _ in range(7)] == [True] * 5 + [False] * 2
+    assert bucket.dropped == 2
+
+    bucket = TokenBucket(0.5)
+    assert bucket.capacity == 1
+    assert bucket.take() is True
+    assert bucket.take() is False
+
+
+def test_refills_over_time(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("time.monotonic", lambda: now[0])
+    bucket = TokenBucket(2, capacity=4)
+    assert sum(bucket.take() for _ in range(10)) == 4
+    now[0] += 1.0
+    assert sum(bucket.take() for _ in range(10)) == 2
+    now[0] += 60.0
+    assert sum(bucket.take() for _ in range(10)) == 4
+
+
+def test_is_thread_safe():
+    bucket = TokenBucket(0.001, capacity=1000)
+    taken = []
+
+    def take():
+        taken.extend(bucket.take() for _ in range(500))
+
+    threads = [threading.Thread(target=take) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert taken.count(True) == 1000
+    assert bucket.dropped == 1000
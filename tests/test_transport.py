@@ -0,0 +1,112 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+
+import threading
+
+import pytest
+
+from tests.test_helper import DEMO_URL, MOCK_AGENT, MockSession
+from usagelogger import BaseLogger, Transport
+
+
+class RecordingSession(MockSession):
+    def __init__(self):
+        super().__init__()
+        self.closed = 0
+        self.timeouts = []
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        self.timeouts.append(kwargs.get("timeout"))
+        return super().post(url, data, headers)
+
+    def close(self):
+        self.closed += 1
+
+
+def test_posts_with_timeouts_and_keep_alive():
+    conn = RecordingSession()
+    logger = BaseLogger(
+        MOCK_AGENT,
+        url=DEMO_URL,
+        transport=Transport(connect_timeout=2, read_timeout=7, session=conn),
+    )
+    assert logger.conn is conn
+    logger.submit([["now", "1"]])
+    assert conn.timeouts == [(2, 7)]
+    assert conn.posts[0]["headers"]["Connection"] == "keep-alive"
+
+    transport = Transport(keep_alive=False, session=conn)
+    transport.post(DEMO_URL, b"", {})
+    assert conn.posts[1]["headers"]["Connection"] == "close"
+    assert transport.in_flight == 0
+
+
+def test_closes_idle_connections():
+    conn = RecordingSession()
+    transport = Transport(idle_timeout=60)
+    transport.session = conn
+    transport.post(DEMO_URL, b"", {})
+    assert conn.closed == 0
+    transport._last_used -= 61
+    transport.post(DEMO_URL, b"", {})
+    assert conn.closed == 1
+    assert len(conn.posts) == 2
+
+
+def test_leaves_sessions_passed_in_open():
+    conn = RecordingSession()
+    transport = Transport(idle_timeout=60, session=conn)
+    transport._last_used -= 61
+    transport.post(DEMO_URL, b"", {})
+    assert conn.closed == 0
+
+
+def test_rejects_invalid_pool_settings():
+    with pytest.raises(ValueError):
+        Transport(pool_size=0)
+    with pytest.raises(ValueError):
+        BaseLogger(MOCK_AGENT, url=DEMO_URL, max_in_flight=0)
+
+
+def test_posts_batches_concurrently(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    started = threading.Barrier(3, timeout=5)
+
+    class ConcurrentSession(MockSession):
+        def post(self, url, data=None, headers=None, **kwargs):
+            started.wait()  # every post waits until three are in flight
+            return super().post(url, data, headers, **kwargs)
+
+    conn = ConcurrentSession()
+    logger = BaseLogger(
+        MOCK_AGENT,
+        url=DEMO_URL,
+        conn=conn,
+        batch_size=1,
+        batch_interval=0.01,
+        max_in_flight=3,
+    )
+    for i in range(3):
+        logger.submit([["now", str(i)]])
+    logger.flush()
+    assert sorted(p["body"] for p in conn.posts) == [
+        b'[["now","0"]]',
+        b'[["now","1"]]',
+        b'[["now","2"]]',
+    ]
+    assert logger.submit_successes == 3
+    assert logger.submit_failures == 0
+
+
+def test_shuts_down_posting_threads_on_close(monkeypatch):
+    monkeypatch.setenv("DEBUG", "False")
+    conn = MockSession()
+    logger = BaseLogger(MOCK_AGENT, url=DEMO_URL, conn=conn, max_in_flight=2)
+    logger.submit([["now", "1"]])
+    logger.flush()
+    posters = logger._posters
+    assert posters is not None
+    logger.close()
+    assert logger._posters is None
+    assert posters._shutdown is True
+    assert len(conn.posts) == 1
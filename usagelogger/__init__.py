@@ -1,20 +1,36 @@
 from . import middleware  # noqa
+from .adaptive_sampler import AdaptiveSampler  # noqa
+from .async_http_logger import AsyncHttpLogger  # noqa
 from .base_logger import BaseLogger  # noqa
+from .circuit_breaker import CircuitBreaker  # noqa
+from .disk_spool import DiskSpool  # noqa
+from .http_details import HttpDetails  # noqa
 from .http_logger import HttpLogger  # noqa
 from .http_message import HttpMessage  # noqa
 from .http_request_impl import HttpRequestImpl  # noqa
 from .http_response_impl import HttpResponseImpl  # noqa
 from .http_rules import HttpRules  # noqa
+from .retry_policy import RetryPolicy  # noqa
+from .serializers import Serializer  # noqa
+from .transport import Transport  # noqa
 from .usage_loggers import UsageLoggers  # noqa
 
 __version__ = "2.2.6"
 
 __all___ = [
     "UsageLoggers",
+    "AdaptiveSampler",
+    "AsyncHttpLogger",
     "HttpRequestImpl",
     "HttpResponseImpl",
     "HttpRules",
+    "RetryPolicy",
+    "Serializer",
+    "Transport",
     "BaseLogger",
+    "CircuitBreaker",
+    "DiskSpool",
+    "HttpDetails",
     "HttpLogger",
     "HttpMessage",
     "resurface",
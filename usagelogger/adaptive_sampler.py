@@ -0,0 +1,69 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import threading
+import time
+from typing import Optional
+
+
+class AdaptiveSampler(object):
+    """Scales down the percentage of messages kept while a logger is under
+    pressure, meaning its submission queue is filling up or posts to the
+    collector are slow. The rate is cut by a factor each interval that pressure
+    persists, and raised a step at a time once it eases."""
+
+    def __init__(
+        self,
+        queue_threshold: float = 0.5,
+        latency_threshold: float = 2.0,
+        min_rate: float = 1.0,
+        decrease: float = 0.5,
+        increase: float = 10.0,
+        interval: float = 1.0,
+    ) -> None:
+        if not 0 < min_rate <= 100:
+            raise ValueError(f"Invalid minimum rate: {min_rate}")
+        if not 0 < decrease < 1:
+            raise ValueError(f"Invalid decrease factor: {decrease}")
+        self.queue_threshold = queue_threshold
+        self.latency_threshold = latency_threshold
+        self.min_rate = min_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.interval = interval
+        self._rate = 100.0
+        self._latency: Optional[float] = None
+        self._lock = threading.Lock()
+        self._updated = time.monotonic()
+
+    @property
+    def latency(self) -> Optional[float]:
+        """Moving average of recent post latency, in seconds."""
+        return self._latency
+
+    @property
+    def rate(self) -> float:
+        """Percentage of messages currently kept."""
+        return self._rate
+
+    def record_latency(self, seconds: float) -> None:
+        with self._lock:
+            if self._latency is None:
+                self._latency = seconds
+            else:
+                self._latency += 0.3 * (seconds - self._latency)
+
+    def update(self, queue_fill: float) -> float:
+        """Re-evaluates pressure, given how full the queue is from 0 to 1, at
+        most once per interval. Returns the rate now in effect."""
+        now = time.monotonic()
+        if now - self._updated < self.interval:
+            return self._rate
+        with self._lock:
+            self._updated = now
+            if queue_fill >= self.queue_threshold or (
+                self._latency is not None and self._latency >= self.latency_threshold
+            ):
+                self._rate = max(self.min_rate, self._rate * self.decrease)
+            else:
+                self._rate = min(100.0, self._rate + self.increase)
+            return self._rate
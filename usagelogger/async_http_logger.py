@@ -0,0 +1,296 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import asyncio
+import concurrent.futures
+import importlib.util
+import time
+from typing import TYPE_CHECKING, Coroutine, Dict, List, Optional, Tuple, Union
+
+from .base_logger import _FLUSH, NdjsonBatch
+from .circuit_breaker import CircuitBreaker
+from .http_details import HttpDetails
+from .http_logger import HttpLogger
+from .http_message import HttpMessage
+
+if TYPE_CHECKING:
+    import aiohttp
+
+
+class AsyncHttpLogger(HttpLogger):
+    """Usage logger for asyncio applications. Captured requests are handed to an
+    asyncio.Queue, and a task on the running event loop turns them into batches
+    (applying rules and encoding JSON on an executor thread) and posts them
+    through a pooled aiohttp client session, up to max_in_flight at once. The
+    session uses the pool size, timeouts and keep-alive settings of the logger's
+    transport. Code on the event loop awaits aflush and aclose, while flush and
+    close wait for them from other threads."""
+
+    # Agent string identifying this logger.
+    AGENT: str = "async_http_logger.py"
+
+    # HttpLogger options that only apply to loggers with a submission thread
+    SYNC_ONLY: Tuple[str, ...] = (
+        "spool",
+        "overflow",
+        "overflow_timeout",
+        "queue_bytes",
+    )
+
+    def __init__(self, *args, **kwargs) -> None:
+        for option in self.SYNC_ONLY:
+            if option in kwargs:
+                raise TypeError(f"AsyncHttpLogger does not support {option}")
+        super().__init__(*args, **kwargs)
+        if self.url is not None and importlib.util.find_spec("aiohttp") is None:
+            raise ImportError("AsyncHttpLogger requires aiohttp to submit to a url")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async_queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._session: Optional["aiohttp.ClientSession"] = None
+
+    def enqueue(
+        self,
+        request,
+        response,
+        response_body: Optional[str] = None,
+        request_body: Optional[str] = None,
+        now=None,
+        interval=None,
+        custom_fields: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Queues a request and response to be logged, without blocking. Must be
+        called from the event loop thread."""
+        if not self.enabled or self.skip_submission is True:
+            return
+        if now is None:
+            now = round(time.time() * 1000)  # when the request ended, not the batch
+        self.__put(
+            {
+                "request": request,
+                "response": response,
+                "response_body": response_body,
+                "request_body": request_body,
+                "now": now,
+                "interval": interval,
+                "custom_fields": custom_fields,
+            }
+        )
+
+    def submit(self, msg: Union[list, HttpDetails]) -> None:
+        """Queues a finished message. Must be called from the event loop thread
+        unless the logger writes to a list queue."""
+        if not msg or self.skip_submission is True or self.enabled is False:
+            pass
+        elif self._queue is not None:
+            super().submit(msg)
+        else:
+            self.__put(msg)
+
+    def __put(self, item) -> None:
+        q = self.__start()
+        try:
+            q.put_nowait(item)
+        except asyncio.QueueFull:
+            with self._submit_dropped_lock:
+                self._submit_dropped += 1
+
+    def __start(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            stale = None
+            if self._loop is not loop:
+                stale = self.__release_session()
+            self._loop = loop
+            self._async_queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = loop.create_task(self.__run(stale))
+        return self._async_queue  # type: ignore
+
+    def __release_session(self) -> Optional["aiohttp.ClientSession"]:
+        """Lets go of the session opened on an earlier event loop, closing it on
+        that loop if it still runs, or else returning it to close on this one."""
+        session, self._session = self._session, None
+        old = self._loop
+        if session is not None and old is not None and old.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), old)
+            return None
+        return session
+
+    async def __run(self, stale: Optional["aiohttp.ClientSession"] = None) -> None:
+        if stale is not None:
+            await stale.close()
+        loop = asyncio.get_running_loop()
+        q: asyncio.Queue = self._async_queue  # type: ignore
+        while True:
+            items = [await q.get()]
+            deadline = loop.time() + self.batch_interval
+            while len(items) < self.batch_size and items[-1] is not _FLUSH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(q.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                batches = await loop.run_in_executor(None, self.__prepare, items)
+                n = self.max_in_flight
+                for i in range(0, len(batches), n):
+                    await asyncio.gather(*map(self.__post, batches[i : i + n]))
+            except Exception:
+                self._count_failure()  # keep submitting later drains
+            finally:
+                for _ in items:
+                    q.task_done()
+
+    def __prepare(self, items: list) -> List[NdjsonBatch]:
+        """Builds messages and encodes them into batches, off the event loop."""
+        batches: List[NdjsonBatch] = []
+        for item in items:
+            if item is _FLUSH:
+                continue
+            try:
+                msg = (
+                    HttpMessage.prepare(self, **item)
+                    if isinstance(item, dict)
+                    else item
+                )
+                if msg is None:
+                    continue
+                if self._queue is not None:
+                    self._queue.append(self.serializer.dumps(msg))
+                    with self._submit_successes_lock:
+                        self._submit_successes += 1
+                    continue
+                if not batches or batches[-1].size >= self.batch_bytes:
+                    compression = None if self.skip_compression else self.compression
+                    batches.append(
+                        NdjsonBatch(
+                            compression,
+                            self.compression_level,
+                            serializer=self.serializer,
+                        )
+                    )
+                batches[-1].write(msg)
+            except Exception:
+                # includes errors raised while building the message
+                self._count_failure()
+                if batches and not batches[-1].count:
+                    batches.pop()
+        return batches
+
+    async def __post(self, batch: NdjsonBatch) -> None:
+        import aiohttp
+
+        if self._session is None:
+            t = self.transport
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=t.pool_size,
+                    force_close=not t.keep_alive,
+                    keepalive_timeout=t.idle_timeout if t.keep_alive else None,
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=t.connect_timeout, sock_read=t.read_timeout
+                ),
+            )
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            # fail fast while the collector is unhealthy
+            with self._submit_dropped_lock:
+                self._submit_dropped += batch.count
+            return
+        recorded = False
+        try:
+            data = batch.getvalue()
+            headers = self._submission_headers(batch)
+            attempt = 0
+            while True:
+                status: Optional[int] = None
+                retry_after: Optional[float] = None
+                started = time.monotonic()
+                try:
+                    async with self._session.post(
+                        self.url, data=data, headers=headers
+                    ) as response:
+                        if self.adaptive_sampler is not None:
+                            self.adaptive_sampler.record_latency(
+                                time.monotonic() - started
+                            )
+                        status = response.status
+                        if status != 204:
+                            retry_after = self.retry_after(response)
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+                    if self.adaptive_sampler is not None:
+                        self.adaptive_sampler.record_latency(time.monotonic() - started)
+                if breaker is not None:
+                    breaker.record(status)
+                    recorded = True
+                if status == 204:
+                    with self._submit_successes_lock:
+                        self._submit_successes += 1
+                    return
+                attempt += 1
+                if (
+                    self.retry_policy is None
+                    or attempt >= self.retry_policy.max_attempts
+                    or not self.retry_policy.retryable(status)
+                    or (breaker is not None and breaker.state == CircuitBreaker.OPEN)
+                ):
+                    self._count_failure()
+                    return
+                await asyncio.sleep(self.retry_policy.delay(attempt, retry_after))
+        finally:
+            # the breaker may have let this batch through as its only probe
+            if breaker is not None and not recorded:
+                breaker.record_failure()
+
+    def _queue_fill(self) -> float:
+        q = self._async_queue
+        return 0.0 if q is None else q.qsize() / self.queue_size
+
+    async def aflush(self) -> None:
+        """Sends any queued messages now and waits until they are submitted."""
+        if self._task is not None and not self._task.done():
+            q: asyncio.Queue = self._async_queue  # type: ignore
+            await q.put(_FLUSH)
+            await q.join()
+
+    async def aclose(self) -> None:
+        """Flushes queued messages, then stops the submission task and closes
+        the client session."""
+        await self.aflush()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def flush(self) -> None:
+        """Waits for aflush from a thread other than the event loop's."""
+        self.__wait(self.aflush(), None)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Waits for aclose from a thread other than the event loop's, for up to
+        timeout seconds."""
+        self.__wait(self.aclose(), timeout)
+
+    def __wait(self, coro: Coroutine, timeout: Optional[float]) -> None:
+        loop = self._loop
+        if loop is None or not loop.is_running():
+            coro.close()  # nothing left running to submit or close
+            self._task = None
+            self._session = None
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            coro.close()
+            raise RuntimeError("Await aflush or aclose on the event loop instead")
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
@@ -1,21 +1,193 @@
 # coding: utf-8
 # © 2016-2024 Graylog, Inc.
-import json
+import atexit
 import os
+import random
 import socket
 import threading
+import time
 import zlib
-from queue import Queue
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
+from typing import Callable, Dict, List, Optional, Set, Union
 from urllib.parse import urlsplit
 
 import requests
 
 import usagelogger  # just to read version
 
+from .adaptive_sampler import AdaptiveSampler
+from .circuit_breaker import CircuitBreaker
+from .disk_spool import DiskSpool
+from .http_details import PREFIXES, HttpDetails
+from .retry_policy import RetryPolicy
+from .serializers import Serializer, select_serializer
+from .transport import Transport
 from .usage_loggers import UsageLoggers
 
-enclosure_queue: Queue = Queue()
+# marker asking the submission worker to send its current batch right away
+_FLUSH = object()
+
+# marker asking the submission worker to send its current batch and stop
+_CLOSE = object()
+
+# most seconds to wait for each logger's pending messages at interpreter exit
+_EXIT_TIMEOUT: float = 5.0
+
+COMPRESSIONS = {"deflate": ("deflated", 15), "gzip": ("gzip", 31)}
+
+# uncompressed bytes held by a compressed batch before they are compressed
+_COMPRESS_BYTES: int = 64 * 1024
+
+# outcomes of posting a batch: sent, failed in a way worth trying again later,
+# or rejected for good
+_SENT, _RETRYABLE, _REJECTED = range(3)
+
+# decides which failures are worth spooling when no retry policy is given
+_DEFAULT_RETRY_POLICY = RetryPolicy()
+
+OVERFLOW_POLICIES = ("drop_newest", "drop_oldest", "block", "sample")
+
+
+class NdjsonBatch:
+    """Builds one NDJSON request body, compressing the whole batch as a single
+    stream while messages are appended. Messages are encoded straight into a
+    bytearray, which compressed batches empty every _COMPRESS_BYTES."""
+
+    def __init__(
+        self,
+        compression: Optional[str] = None,
+        level: int = 6,
+        keep_messages: bool = False,
+        serializer: Optional[Serializer] = None,
+    ) -> None:
+        self.compression = compression
+        self.messages: Optional[List[str]] = [] if keep_messages else None
+        self.count = 0
+        self.size = 0  # before compression
+        self._serializer = select_serializer(serializer)
+        self.buffer = bytearray()
+        self._chunks: List[bytes] = []
+        self._compressor = None
+        if compression is not None:
+            self._compressor = zlib.compressobj(
+                level, zlib.DEFLATED, COMPRESSIONS[compression][1]
+            )
+
+    def append(self, msg: str) -> None:
+        """Adds a message that is already serialized."""
+        data = msg.encode("utf-8")
+        self.__add(lambda buffer: buffer.extend(data))
+
+    def write(self, msg) -> None:
+        """Encodes and adds a message, adding nothing if it can't be encoded."""
+        self.__add(lambda buffer: self._serializer.write(msg, buffer))
+
+    def __add(self, encode: Callable[[bytearray], None]) -> None:
+        buffer = self.buffer
+        start = len(buffer)
+        if self.count:
+            buffer += b"\n"
+        offset = len(buffer)
+        try:
+            encode(buffer)
+        except BaseException:
+            del buffer[start:]
+            raise
+        if self.messages is not None:
+            self.messages.append(buffer[offset:].decode("utf-8"))
+        self.count += 1
+        self.size += len(buffer) - offset + 1
+        if self._compressor is not None and len(buffer) >= _COMPRESS_BYTES:
+            self.__compress(self._compressor)
+
+    def __compress(self, compressor) -> None:
+        chunk = compressor.compress(self.buffer)
+        if chunk:
+            self._chunks.append(chunk)
+        self.buffer.clear()
+
+    def getvalue(self) -> Union[bytes, bytearray]:
+        """Returns the request body. Uncompressed batches return their buffer
+        itself rather than a copy, so it must not be changed until the body has
+        been posted."""
+        if self._compressor is None:
+            return self.buffer
+        self.__compress(self._compressor)
+        self._chunks.append(self._compressor.flush())
+        self._compressor = None
+        return b"".join(self._chunks)
+
+
+class EnclosureQueue(Queue):
+    """FIFO of pending payloads that also tracks their estimated size in bytes."""
+
+    def _init(self, maxsize: int) -> None:
+        super()._init(maxsize)
+        self.bytes = 0
+
+    def _put(self, item) -> None:
+        self.queue.append(item)
+        if isinstance(item, dict):
+            self.bytes += item["size"]
+
+    def _get(self):
+        item = self.queue.popleft()
+        if isinstance(item, dict):
+            self.bytes -= item["size"]
+        return item
+
+    def _is_full(self, size: int, max_items: int, max_bytes: int) -> bool:
+        depth = len(self.queue)
+        return depth > 0 and (depth >= max_items or self.bytes + size > max_bytes)
+
+    def offer(
+        self,
+        item: dict,
+        max_items: int,
+        max_bytes: int,
+        policy: str = "drop_newest",
+        timeout: float = 0.0,
+    ) -> List[dict]:
+        """Adds an item while holding the queue to the given limits, applying the
+        overflow policy when they would be exceeded. Returns the items dropped,
+        which includes the offered item if it was not accepted."""
+        size = item["size"]
+        dropped: List[dict] = []
+        with self.not_full:
+            if policy == "sample":
+                # start shedding at half capacity, keeping fewer messages the
+                # closer the queue gets to its limits
+                load = max(len(self.queue) / max_items, self.bytes / max_bytes)
+                if load >= 1.0 or (load > 0.5 and random.random() < 2 * load - 1):
+                    return [item]
+            elif policy == "drop_oldest":
+                while self._is_full(size, max_items, max_bytes):
+                    oldest = next((x for x in self.queue if isinstance(x, dict)), None)
+                    if oldest is None:
+                        break
+                    self.queue.remove(oldest)
+                    self.bytes -= oldest["size"]
+                    self._task_done_locked()
+                    dropped.append(oldest)
+            elif policy == "block":
+                deadline = time.monotonic() + timeout
+                while self._is_full(size, max_items, max_bytes):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return [item]
+                    self.not_full.wait(remaining)
+            elif self._is_full(size, max_items, max_bytes):
+                return [item]
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        return dropped
+
+    def _task_done_locked(self) -> None:
+        self.unfinished_tasks -= 1
+        if self.unfinished_tasks == 0:
+            self.all_tasks_done.notify_all()
 
 
 class BaseLogger:
@@ -29,15 +201,56 @@ class BaseLogger:
         url: Optional[str] = None,
         skip_compression: bool = False,
         skip_submission: bool = False,
-        conn: requests.Session = requests.Session(),
+        conn: Optional[requests.Session] = None,
+        compression: str = "deflate",
+        compression_level: int = 6,
+        batch_size: int = 100,
+        batch_bytes: int = 1024 * 1024,
+        batch_interval: float = 1.0,
+        queue_size: int = 10000,
+        queue_bytes: int = 64 * 1024 * 1024,
+        overflow: str = "drop_newest",
+        overflow_timeout: float = 0.1,
+        spool: Optional[DiskSpool] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        adaptive_sampler: Optional[AdaptiveSampler] = None,
+        serializer: Union[str, Serializer, None] = None,
+        transport: Optional[Transport] = None,
+        max_in_flight: int = 1,
     ) -> None:
 
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Invalid compression: {compression}")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy: {overflow}")
+        if max_in_flight < 1:
+            raise ValueError(f"Invalid max in flight: {max_in_flight}")
+
         self.agent = agent
         self.host = self.host_lookup()
         self.skip_compression = skip_compression
         self.skip_submission = skip_submission
         self.version = self.version_lookup()
-        self.conn = conn
+        self.transport = transport if transport is not None else Transport(session=conn)
+        self.conn = self.transport.session
+        self.max_in_flight = max_in_flight
+        self.compression = compression
+        self.compression_level = compression_level
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_interval = batch_interval
+        self.queue_size = queue_size
+        self.queue_bytes = queue_bytes
+        self.overflow = overflow
+        self.overflow_timeout = overflow_timeout
+        self.spool = spool
+        self.retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+        self.adaptive_sampler = adaptive_sampler
+        self.serializer = select_serializer(
+            serializer or UsageLoggers.serializer_by_default()
+        )
 
         # read provided options
         if url is None:
@@ -63,11 +276,21 @@ class BaseLogger:
 
         # finalize internal properties
         self._enableable = self.queue is not None or self.url is not None
+        self._submit_dropped = 0
+        self._submit_dropped_lock = threading.Lock()
         self._submit_failures = 0
         self._submit_failures_lock = threading.Lock()
         self._submit_successes = 0
         self._submit_successes_lock = threading.Lock()
 
+        # each logger submits through its own queue, worker and connection
+        self._enclosure_queue = EnclosureQueue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+        self._posters: Optional[ThreadPoolExecutor] = None
+        self._posting = threading.BoundedSemaphore(max_in_flight)
+        self._replay_lock = threading.Lock()
+
     def disable(self):
         self._enabled = False
         return self
@@ -89,56 +312,262 @@ class BaseLogger:
     def queue(self) -> Optional[List[str]]:
         return self._queue
 
-    def __internal_submission(self, q: Queue):
-        try:
-            headers: Dict[str, str] = {
-                "Connection": "keep-alive",
-                "Content-Type": "application/ndjson; charset=UTF-8",
-                "User-Agent": "Resurface/"
-                + usagelogger.__version__
-                + " ("
-                + self.agent
-                + ")",
-            }
-
-            to_submit = []
-
-            cnt = 0
-
-            while not q.empty() or cnt == 100:
-                payload = q.get()
-                payload["msg"] = json.dumps(payload["msg"], separators=(",", ":"))
-                if not payload["skip_compression"]:
-                    body = payload["msg"]
+    def _count_failure(self) -> None:
+        with self._submit_failures_lock:
+            self._submit_failures += 1
+
+    def __submission_worker(self) -> None:
+        """Drains this logger's enclosure queue for the lifetime of the process.
+        Each batch is posted once it reaches batch_size messages or batch_bytes
+        bytes, once its oldest message has waited batch_interval seconds, or when
+        a flush is requested."""
+        q = self._enclosure_queue
+        closing = False
+        while not closing:
+            batch: Optional[NdjsonBatch] = None
+            deadline = 0.0
+            while True:
+                if batch is None:
+                    if self.spool is None or self.spool.empty:
+                        payload = q.get()
+                    else:
+                        # retry spooled messages while idle
+                        try:
+                            payload = q.get(timeout=self.batch_interval)
+                        except Empty:
+                            try:
+                                self.__replay()
+                            except Exception:
+                                self._count_failure()
+                            continue
                 else:
-                    headers["Content-Encoding"] = "deflated"
-                    body = zlib.compress(payload["msg"])
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        payload = q.get(timeout=timeout)
+                    except Empty:
+                        break
+
+                if payload is _FLUSH or payload is _CLOSE:
+                    q.task_done()
+                    closing = payload is _CLOSE
+                    break
 
-                to_submit.append(body)
-                cnt += 1
-                q.task_done()
+                try:
+                    msg = self.__build(payload["msg"])
+                    if msg is not None:
+                        if batch is None:
+                            batch = self.__new_batch()
+                            deadline = time.monotonic() + self.batch_interval
+                        batch.write(msg)
+                except Exception:
+                    # includes errors raised by deferred builders
+                    self._count_failure()
+                    msg = None
+                    if batch is not None and not batch.count:
+                        batch = None
+                if msg is None or batch is None:
+                    q.task_done()
+                    continue
+                if batch.count >= self.batch_size or batch.size >= self.batch_bytes:
+                    break
 
-            # print(f"submitting {len(to_submit)} at once")
-            ndjson_payload = ("\n".join(to_submit)).encode("utf-8")
-            response = self.conn.post(
-                payload["url"], data=ndjson_payload, headers=headers
+            if batch is not None:
+                self.__dispatch(batch)
+
+    def __dispatch(self, batch: NdjsonBatch) -> None:
+        """Submits a batch, on another thread if several posts may be in flight
+        at once, in which case this waits while max_in_flight are."""
+        if self.max_in_flight == 1:
+            self.__send(batch)
+            return
+        self._posting.acquire()
+        if self._posters is None:
+            self._posters = ThreadPoolExecutor(
+                self.max_in_flight, thread_name_prefix="submission_post"
             )
-            if response.status_code == 204:
-                with self._submit_successes_lock:
-                    self._submit_successes += 1
+        try:
+            self._posters.submit(self.__send, batch, True)
+        except RuntimeError:
+            # shut down, as happens when closing at interpreter exit
+            self.__send(batch, True)
+
+    def __send(self, batch: NdjsonBatch, posting: bool = False) -> None:
+        try:
+            self._submit_batch(batch)
+        except Exception:
+            self._count_failure()
+        finally:
+            if posting:
+                self._posting.release()
+            for _ in range(batch.count):
+                self._enclosure_queue.task_done()
+
+    def _submission_headers(self, batch: NdjsonBatch) -> Dict[str, str]:
+        headers: Dict[str, str] = {
+            "Content-Type": "application/ndjson; charset=UTF-8",
+            "User-Agent": "Resurface/"
+            + usagelogger.__version__
+            + " ("
+            + self.agent
+            + ")",
+        }
+        if batch.compression is not None:
+            headers["Content-Encoding"] = COMPRESSIONS[batch.compression][0]
+        return headers
+
+    def __new_batch(self) -> NdjsonBatch:
+        return NdjsonBatch(
+            None if self.skip_compression else self.compression,
+            self.compression_level,
+            keep_messages=self.spool is not None,
+            serializer=self.serializer,
+        )
+
+    def _submit_batch(self, batch: NdjsonBatch) -> None:
+        if self.spool is not None and not self.spool.empty:
+            # keep this batch behind the messages spooled before it
+            self.__spool(batch.messages)  # type: ignore
+            self.__replay()
+        elif not self.__available():
+            # fail fast while the collector is unhealthy
+            if self.spool is not None:
+                self.__spool(batch.messages)  # type: ignore
             else:
-                with self._submit_failures_lock:
-                    self._submit_failures += 1
-        # http errors
-        except (requests.exceptions.RequestException, IOError, OSError):
-            with self._submit_failures_lock:
-                self._submit_failures += 1
-        # JSON errors
-        except (OverflowError, TypeError, ValueError):
-            with self._submit_failures_lock:
-                self._submit_failures += 1
-
-    def submit(self, msg: list) -> None:
+                with self._submit_dropped_lock:
+                    self._submit_dropped += batch.count
+        elif self.__post(batch) == _RETRYABLE and self.spool is not None:
+            self.__spool(batch.messages)  # type: ignore
+
+    def __spool(self, messages: List[str]) -> None:
+        if not self.spool.append(messages):  # type: ignore
+            with self._submit_dropped_lock:
+                self._submit_dropped += len(messages)
+
+    def __replay(self) -> None:
+        """Resends spooled messages in order until the spool is empty or a
+        submission fails. Only one thread replays at a time."""
+        if not self._replay_lock.acquire(blocking=False):
+            return
+        try:
+            self.__replay_locked()
+        finally:
+            self._replay_lock.release()
+
+    def __replay_locked(self) -> None:
+        while True:
+            messages, size = self.spool.peek(  # type: ignore
+                self.batch_size, self.batch_bytes
+            )
+            if not messages:
+                if not size:
+                    return
+                self.spool.commit(size)  # type: ignore  # only corrupt lines
+                continue
+            if not self.__available():
+                return
+            batch = self.__new_batch()
+            for msg in messages:
+                batch.append(msg)
+            # batches the collector rejects for good are dropped, not retried
+            # forever ahead of everything spooled after them
+            if self.__post(batch) == _RETRYABLE:
+                return
+            self.spool.commit(size)  # type: ignore
+
+    def __available(self) -> bool:
+        return self.circuit_breaker is None or self.circuit_breaker.allow()
+
+    def __post(self, batch: NdjsonBatch) -> int:
+        breaker = self.circuit_breaker
+        recorded = False
+        try:
+            try:
+                data = batch.getvalue()
+            # compression errors
+            except zlib.error:
+                self._count_failure()
+                return _REJECTED
+            headers = self._submission_headers(batch)
+            attempt = 0
+            while True:
+                status: Optional[int] = None
+                retry_after: Optional[float] = None
+                started = time.monotonic()
+                try:
+                    response = self.transport.post(self.url, data, headers)
+                    if self.adaptive_sampler is not None:
+                        self.adaptive_sampler.record_latency(time.monotonic() - started)
+                    status = response.status_code
+                    if status != 204:
+                        retry_after = self.retry_after(response)
+                # http errors
+                except (requests.exceptions.RequestException, IOError, OSError):
+                    if self.adaptive_sampler is not None:
+                        self.adaptive_sampler.record_latency(time.monotonic() - started)
+                if breaker is not None:
+                    breaker.record(status)
+                    recorded = True
+                if status == 204:
+                    with self._submit_successes_lock:
+                        self._submit_successes += 1
+                    return _SENT
+                attempt += 1
+                policy = self.retry_policy or _DEFAULT_RETRY_POLICY
+                if (
+                    self.retry_policy is None
+                    or attempt >= policy.max_attempts
+                    or not policy.retryable(status)
+                    or (breaker is not None and breaker.state == CircuitBreaker.OPEN)
+                ):
+                    self._count_failure()
+                    return _RETRYABLE if policy.retryable(status) else _REJECTED
+                time.sleep(self.retry_policy.delay(attempt, retry_after))
+        finally:
+            # the breaker may have let this batch through as its only probe
+            if breaker is not None and not recorded:
+                breaker.record_failure()
+
+    def _queue_fill(self) -> float:
+        """How full the submission queue is, from 0 to 1."""
+        q = self._enclosure_queue
+        return max(q.qsize() / self.queue_size, q.bytes / self.queue_bytes)
+
+    def __start_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self.__submission_worker,
+                    name="submission_thread",
+                    daemon=True,
+                )
+                self._worker.start()
+                _live_loggers.add(self)
+
+    def flush(self) -> None:
+        """Sends any batched messages now and waits until they are submitted."""
+        if self._worker is not None and self._worker.is_alive():
+            self._enclosure_queue.put(_FLUSH)
+            self._enclosure_queue.join()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Sends any batched messages, then stops the submission worker once they
+        are submitted or after timeout seconds. Submitting again starts a new
+        worker. A logger with a running worker is never garbage collected, so
+        loggers that are done with before the process exits must be closed."""
+        worker = self._worker
+        if worker is not None and worker.is_alive():
+            self._enclosure_queue.put(_CLOSE)
+            worker.join(timeout)
+        posters, self._posters = self._posters, None
+        if posters is not None:
+            posters.shutdown(wait=timeout is None)
+        _live_loggers.discard(self)
+
+    def submit(self, msg: Union[list, HttpDetails]) -> None:
         """Submits JSON message to intended destination."""
 
         if (
@@ -149,28 +578,68 @@ class BaseLogger:
         ):
             pass
         elif self._queue is not None:
-            self._queue.append(json.dumps(msg, separators=(",", ":")))
+            self._queue.append(self.serializer.dumps(msg))
             with self._submit_successes_lock:
                 self._submit_successes += 1
         else:
-            payload = {
-                "url": self.url,
-                "msg": msg,
-                "skip_compression": self.skip_compression,
-            }
-            enclosure_queue.put(payload)
-            if "submission_thread" not in [x.name for x in threading.enumerate()]:
-                worker = threading.Thread(
-                    target=self.__internal_submission,
-                    args=(enclosure_queue,),
-                )
-                worker.name = "submission_thread"
-                worker.setDaemon(True)
-                worker.start()
-                if os.environ.get("DEBUG") == "True":
-                    worker.join()  # Not a good practice but required for that success and failure counts
+            self.__enqueue({"msg": msg, "size": self.estimated_size(msg)})
+
+    def submit_deferred(
+        self, build: Callable[[], Union[list, HttpDetails, None]], size: int = 0
+    ) -> None:
+        """Queues a callable that builds the message to submit, or returns None if
+        there is nothing to submit. It runs later on the submission worker, so
+        that request threads only pay for capturing what it needs. The size is
+        an estimate of the message it will build."""
+        if self.skip_submission is True or self.enabled is False:
+            pass
+        elif self._queue is not None:
+            msg = build()
+            if msg:
+                self.submit(msg)
+        else:
+            self.__enqueue({"msg": build, "size": size})
+
+    def __enqueue(self, payload: dict) -> None:
+        dropped = self._enclosure_queue.offer(
+            payload,
+            self.queue_size,
+            self.queue_bytes,
+            self.overflow,
+            self.overflow_timeout,
+        )
+        if dropped and self.spool is not None:
+            # spill to disk rather than shedding, except for deferred messages,
+            # which would have to be built here on the caller's thread
+            ready = [p["msg"] for p in dropped if not callable(p["msg"])]
+            if len(ready) < len(dropped):
+                with self._submit_dropped_lock:
+                    self._submit_dropped += len(dropped) - len(ready)
+            try:
+                if ready:
+                    self.__spool([self.serializer.dumps(m) for m in ready])
+            except Exception:
+                self._count_failure()
+        elif dropped:
+            with self._submit_dropped_lock:
+                self._submit_dropped += len(dropped)
+        self.__start_worker()
+        if os.environ.get("DEBUG") == "True":
+            self.flush()  # Not a good practice but required for that success and failure counts
+
+    @staticmethod
+    def __build(msg):
+        """Builds a queued message if it was deferred, giving None if there is
+        nothing to submit."""
+        if callable(msg):
+            msg = msg()
+            if not msg:
+                return None
+        return msg
 
-            # enclosure_queue.join()  # We don't have to block our main thread.
+    @property
+    def submit_dropped(self) -> int:
+        return self._submit_dropped
 
     @property
     def submit_failures(self) -> int:
@@ -184,6 +653,34 @@ class BaseLogger:
     def url(self) -> str:
         return self._url  # type: ignore
 
+    @staticmethod
+    def retry_after(response) -> Optional[float]:
+        """Reads the delay in seconds requested by a Retry-After header."""
+        try:
+            return float(response.headers["Retry-After"])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def estimated_size(msg) -> int:
+        """Approximates the serialized size of a message without encoding it."""
+        if isinstance(msg, HttpDetails):
+            try:
+                return (
+                    sum(len(PREFIXES[k]) + 6 for k in msg.kinds)
+                    + sum(len(n) for n in msg.names if n is not None)
+                    + sum(map(len, msg.values))
+                    + 2
+                )
+            except TypeError:
+                pass
+        elif isinstance(msg, list):
+            try:
+                return sum(len(d[0]) + len(d[1]) + 6 for d in msg) + 2
+            except (IndexError, TypeError):
+                pass
+        return len(str(msg))
+
     @staticmethod
     def host_lookup() -> str:
         dyno = os.getenv("DYNO")
@@ -197,3 +694,15 @@ class BaseLogger:
     @staticmethod
     def version_lookup() -> str:
         return usagelogger.__version__
+
+
+# loggers with a submission worker, closed at exit so that messages submitted
+# just before a short-lived process ends are still sent. A running worker keeps
+# its logger alive anyway, so they are held here until closed.
+_live_loggers: Set["BaseLogger"] = set()
+
+
+@atexit.register
+def _close_live_loggers() -> None:
+    for logger in list(_live_loggers):
+        logger.close(_EXIT_TIMEOUT)
@@ -0,0 +1,65 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import threading
+import time
+from typing import Optional
+
+
+class CircuitBreaker(object):
+    """Stops submissions to a collector that keeps failing. After
+    failure_threshold consecutive failures the circuit opens and submissions
+    fail fast; once reset_timeout seconds pass, a single probe is let through,
+    closing the circuit again if it succeeds."""
+
+    CLOSED: str = "closed"
+    OPEN: str = "open"
+    HALF_OPEN: str = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._state = CircuitBreaker.CLOSED
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def allow(self) -> bool:
+        """Returns True if a submission may be attempted now."""
+        with self._lock:
+            if self._state == CircuitBreaker.CLOSED:
+                return True
+            if (
+                self._state == CircuitBreaker.OPEN
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                self._state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._state = CircuitBreaker.CLOSED
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if (
+                self._state == CircuitBreaker.HALF_OPEN
+                or self._failures >= self.failure_threshold
+            ):
+                self._state = CircuitBreaker.OPEN
+                self._opened_at = time.monotonic()
+
+    def record(self, status: Optional[int]) -> None:
+        """Records a submission by its response status, or None if no response
+        came back. Only connection errors, server errors and 429s are failures,
+        since a collector that turns a batch down for good is still healthy."""
+        if status is None or status >= 500 or status == 429:
+            self.record_failure()
+        else:
+            self.record_success()
@@ -0,0 +1,200 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import os
+import re
+import threading
+from pathlib import Path
+from typing import IO, List, Optional, Tuple, Union
+
+FSYNC_POLICIES = ("always", "segment", "never")
+
+
+class DiskSpool(object):
+    """Write-ahead spool of serialized messages, kept as segmented append-only
+    NDJSON files in a directory. Messages are read back in the order they were
+    written, and a cursor file records how far replay has progressed so that
+    nothing is sent twice or lost across restarts."""
+
+    __SEGMENT: str = "segment-{:08d}.ndjson"
+    __REGEX_SEGMENT = re.compile(r"^segment-(\d{8})\.ndjson$")
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        segment_bytes: int = 8 * 1024 * 1024,
+        max_bytes: int = 256 * 1024 * 1024,
+        fsync: str = "segment",
+    ) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Invalid fsync policy: {fsync}")
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._writer: Optional[IO[bytes]] = None
+
+        # pick up segments left by an earlier process
+        self._segments: List[int] = sorted(
+            int(m.group(1))
+            for m in (self.__REGEX_SEGMENT.match(f.name) for f in self.path.iterdir())
+            if m
+        )
+        self._read_segment, self._read_offset = self.__load_cursor()
+        self._segments = [n for n in self._segments if n >= self._read_segment]
+        if not self._segments:
+            self._segments = [self._read_segment]
+            self._read_offset = 0
+        elif self._read_segment < self._segments[0]:
+            self._read_segment, self._read_offset = self._segments[0], 0
+        self.__truncate_partial_line(self._segments[-1])
+        self._bytes = (
+            sum(
+                self.__segment_path(n).stat().st_size
+                for n in self._segments
+                if self.__segment_path(n).exists()
+            )
+            - self._read_offset
+        )
+
+    def __len__(self) -> int:
+        return self._bytes
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+    @property
+    def empty(self) -> bool:
+        return self._bytes <= 0
+
+    def append(self, messages: List[str]) -> bool:
+        """Appends serialized messages, returning False if they would take the
+        spool past its size cap."""
+        data = "".join(m + "\n" for m in messages).encode("utf-8")
+        with self._lock:
+            if self._bytes + len(data) > self.max_bytes:
+                return False
+            if self._writer is None:
+                self._writer = open(self.__segment_path(self._segments[-1]), "ab")
+            self._writer.write(data)
+            self._writer.flush()
+            if self.fsync == "always":
+                os.fsync(self._writer.fileno())
+            self._bytes += len(data)
+            if self._writer.tell() >= self.segment_bytes:
+                self.__rotate()
+        return True
+
+    def peek(self, max_count: int, max_bytes: int) -> Tuple[List[str], int]:
+        """Returns the oldest unsent messages, up to the given limits, along with
+        the number of spooled bytes they occupy. Nothing is consumed until the
+        same number of bytes is passed to commit."""
+        with self._lock:
+            messages: List[str] = []
+            size = 0
+            segment, offset = self._read_segment, self._read_offset
+            for n in self._segments[self._segments.index(segment) :]:
+                if n != segment:
+                    offset = 0
+                try:
+                    f = open(self.__segment_path(n), "rb")
+                except FileNotFoundError:
+                    continue
+                with f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break  # partially written, wait for the rest
+                        size += len(line)
+                        try:
+                            message = line[:-1].decode("utf-8")
+                        except UnicodeDecodeError:
+                            message = ""  # corrupt, consumed along with the rest
+                        if message:
+                            messages.append(message)
+                        if len(messages) >= max_count or size >= max_bytes:
+                            return messages, size
+            return messages, size
+
+    def commit(self, size: int) -> None:
+        """Consumes the given number of bytes returned by peek, deleting any
+        segments that have been replayed completely."""
+        with self._lock:
+            self._bytes -= size
+            offset = self._read_offset + size
+            while True:
+                seg_path = self.__segment_path(self._read_segment)
+                seg_size = seg_path.stat().st_size if seg_path.exists() else 0
+                if offset < seg_size or self._read_segment == self._segments[-1]:
+                    break
+                offset -= seg_size
+                seg_path.unlink()
+                self._segments.pop(0)
+                self._read_segment = self._segments[0]
+            self._read_offset = offset
+            if self._read_segment == self._segments[-1] and self._bytes <= 0:
+                # everything replayed, so start over with a fresh segment
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+                try:
+                    self.__segment_path(self._read_segment).unlink()
+                except FileNotFoundError:
+                    pass
+                self._read_segment += 1
+                self._read_offset = 0
+                self._segments = [self._read_segment]
+                self._bytes = 0
+            self.__save_cursor()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._writer is not None:
+                if self.fsync != "never":
+                    os.fsync(self._writer.fileno())
+                self._writer.close()
+                self._writer = None
+
+    def __rotate(self) -> None:
+        if self.fsync == "segment":
+            os.fsync(self._writer.fileno())  # type: ignore
+        self._writer.close()  # type: ignore
+        self._writer = None
+        self._segments.append(self._segments[-1] + 1)
+
+    def __truncate_partial_line(self, n: int) -> None:
+        """Cuts off a line left half-written by a crash, so that appends don't
+        run on from it."""
+        try:
+            f = open(self.__segment_path(n), "r+b")
+        except FileNotFoundError:
+            return
+        with f:
+            end = pos = f.seek(0, os.SEEK_END)
+            while pos > 0:
+                start = max(0, pos - 4096)
+                f.seek(start)
+                i = f.read(pos - start).rfind(b"\n")
+                if i >= 0:
+                    pos = start + i + 1
+                    break
+                pos = start
+            if pos < end:
+                f.truncate(pos)
+
+    def __segment_path(self, n: int) -> Path:
+        return self.path / self.__SEGMENT.format(n)
+
+    def __load_cursor(self) -> Tuple[int, int]:
+        try:
+            segment, offset = (self.path / "cursor").read_text().split()
+            return int(segment), int(offset)
+        except (OSError, ValueError):
+            return (self._segments[0] if self._segments else 0), 0
+
+    def __save_cursor(self) -> None:
+        cursor = self.path / "cursor.tmp"
+        cursor.write_text(f"{self._read_segment} {self._read_offset}")
+        cursor.replace(self.path / "cursor")
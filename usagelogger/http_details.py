@@ -0,0 +1,174 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import json
+from enum import IntEnum
+from json.encoder import encode_basestring_ascii
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+
+class DetailKind(IntEnum):
+    """Kinds of message details. Keyed kinds, like headers, are followed by a
+    name in the detail key."""
+
+    OTHER = 0
+    REQUEST_METHOD = 1
+    REQUEST_URL = 2
+    RESPONSE_CODE = 3
+    REQUEST_BODY = 4
+    RESPONSE_BODY = 5
+    NOW = 6
+    INTERVAL = 7
+    HOST = 8
+    REQUEST_HEADER = 9
+    REQUEST_PARAM = 10
+    RESPONSE_HEADER = 11
+    SESSION_FIELD = 12
+    CUSTOM_FIELD = 13
+
+
+# detail key, or key prefix for keyed kinds, indexed by kind
+PREFIXES: Tuple[str, ...] = (
+    "",
+    "request_method",
+    "request_url",
+    "response_code",
+    "request_body",
+    "response_body",
+    "now",
+    "interval",
+    "host",
+    "request_header:",
+    "request_param:",
+    "response_header:",
+    "session_field:",
+    "custom_field:",
+)
+
+_FIRST_KEYED: int = DetailKind.REQUEST_HEADER
+_KINDS_BY_KEY = {PREFIXES[k]: k for k in range(1, _FIRST_KEYED)}
+
+# JSON opening each detail, by kind and name, since the same keys recur in
+# every message
+_OPENINGS: Tuple[Dict[Optional[str], str], ...] = tuple({} for _ in PREFIXES)
+_MAX_OPENINGS: int = 1024
+
+
+class HttpDetails(object):
+    """Details of one message, kept as parallel arrays of kinds, names and values
+    rather than as a list of [key, value] pairs. Keys are only put together when
+    asked for, rules redact values in place, and the message is written straight
+    to JSON. Iterating gives (key, value) tuples, so that a message can be read
+    like a list of details."""
+
+    __slots__ = ("kinds", "names", "values")
+
+    def __init__(self) -> None:
+        self.kinds: List[int] = []
+        self.names: List[Optional[str]] = []
+        self.values: List[str] = []
+
+    @classmethod
+    def of(cls, details: Iterable[Sequence[str]]) -> "HttpDetails":
+        """Copies a list of [key, value] details."""
+        result = cls()
+        for d in details:
+            result.append(d)
+        return result
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        key = self.key
+        return ((key(i), v) for i, v in enumerate(self.values))
+
+    def __getitem__(self, i: int) -> Tuple[str, str]:
+        return self.key(i), self.values[i]
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, HttpDetails):
+            other = other.to_list()
+        return self.to_list() == other
+
+    def __repr__(self) -> str:
+        return f"HttpDetails({self.to_list()!r})"
+
+    def add(self, kind: int, value: str, name: Optional[str] = None) -> None:
+        """Adds a detail, with the name that follows the kind's prefix for keyed
+        kinds. Names are stored as given, so callers pass them in lowercase."""
+        self.kinds.append(kind)
+        self.names.append(name)
+        self.values.append(value)
+
+    def add_items(self, kind: int, items: Iterable[Tuple[str, str]]) -> None:
+        """Adds details of a keyed kind from name and value pairs, like the
+        items of a dict of headers."""
+        names, values = self.names, self.values
+        count = len(values)
+        for k, v in items:
+            names.append(k.lower())
+            values.append(v)
+        self.kinds.extend([kind] * (len(values) - count))
+
+    def append(self, detail: Sequence[str]) -> None:
+        """Adds a [key, value] detail, as for a list of details."""
+        key, value = detail[0], detail[1]
+        kind = _KINDS_BY_KEY.get(key)
+        if kind is not None:
+            self.add(kind, value)
+            return
+        for kind in range(_FIRST_KEYED, len(PREFIXES)):
+            prefix = PREFIXES[kind]
+            if key.startswith(prefix):
+                self.add(kind, value, key[len(prefix) :])
+                return
+        self.add(DetailKind.OTHER, value, key)
+
+    def extend(self, details: Iterable[Sequence[str]]) -> None:
+        for d in details:
+            self.append(d)
+
+    def key(self, i: int) -> str:
+        prefix = PREFIXES[self.kinds[i]]
+        name = self.names[i]
+        return prefix if name is None else prefix + name
+
+    def pairs(self) -> List[Tuple[str, str]]:
+        """Lists the details as (key, value) tuples."""
+        p = PREFIXES
+        return [
+            (p[k] if n is None else p[k] + n, v)
+            for k, n, v in zip(self.kinds, self.names, self.values)
+        ]
+
+    def retain(self, indexes: List[int]) -> None:
+        """Keeps only the details at the given ascending indexes, in place."""
+        kinds, names, values = self.kinds, self.names, self.values
+        for j, i in enumerate(indexes):
+            if i != j:
+                kinds[j], names[j], values[j] = kinds[i], names[i], values[i]
+        n = len(indexes)
+        del kinds[n:], names[n:], values[n:]
+
+    def to_json(self) -> str:
+        """Serializes the message as json.dumps would serialize the same list of
+        [key, value] details, with compact separators."""
+        parts = []
+        for kind, name, value in zip(self.kinds, self.names, self.values):
+            openings = _OPENINGS[kind]
+            opening = openings.get(name)
+            if opening is None:
+                prefix = PREFIXES[kind]
+                key = prefix if name is None else prefix + name
+                opening = "[" + encode_basestring_ascii(key) + ","
+                if len(openings) >= _MAX_OPENINGS:
+                    openings.clear()
+                openings[name] = opening
+            if type(value) is str:
+                parts.append(opening + encode_basestring_ascii(value) + "]")
+            else:
+                parts.append(opening + json.dumps(value, separators=(",", ":")) + "]")
+        return "[" + ",".join(parts) + "]"
+
+    def to_list(self) -> List[List[str]]:
+        return [[k, v] for k, v in self.pairs()]
@@ -1,11 +1,25 @@
 # coding: utf-8
 # © 2016-2024 Graylog, Inc.
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple, TypeVar, Union
+from urllib import parse
 
+from .adaptive_sampler import AdaptiveSampler
 from .base_logger import BaseLogger
+from .circuit_breaker import CircuitBreaker
+from .disk_spool import DiskSpool
+from .http_details import HttpDetails
 from .http_rules import HttpRules
+from .retry_policy import RetryPolicy
+from .serializers import Serializer
+from .transport import Transport
 from .utils.resurface_utils import ResurfaceWarning
 
+# messages are built as HttpDetails, or given as lists of [key, value] details
+Details = TypeVar("Details", HttpDetails, List[List[str]])
+
+# request headers are given as mappings, or as (name, value) pairs like werkzeug's
+Headers = Union[Mapping[str, str], Iterable[Tuple[str, str]]]
+
 
 class HttpLogger(BaseLogger):
     """Usage logger for HTTP/HTTPS protocol."""
@@ -21,6 +35,22 @@ class HttpLogger(BaseLogger):
         skip_compression: bool = False,
         skip_submission: bool = False,
         rules: Optional[str] = None,
+        compression: str = "deflate",
+        compression_level: int = 6,
+        batch_size: int = 100,
+        batch_bytes: int = 1024 * 1024,
+        batch_interval: float = 1.0,
+        queue_size: int = 10000,
+        queue_bytes: int = 64 * 1024 * 1024,
+        overflow: str = "drop_newest",
+        overflow_timeout: float = 0.1,
+        spool: Optional[DiskSpool] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        adaptive_sampler: Optional[AdaptiveSampler] = None,
+        serializer: Union[str, Serializer, None] = None,
+        transport: Optional[Transport] = None,
+        max_in_flight: int = 1,
     ) -> None:
 
         if url and not isinstance(url, str):
@@ -35,6 +65,22 @@ class HttpLogger(BaseLogger):
             url=url,
             skip_compression=skip_compression,
             skip_submission=skip_submission,
+            compression=compression,
+            compression_level=compression_level,
+            batch_size=batch_size,
+            batch_bytes=batch_bytes,
+            batch_interval=batch_interval,
+            queue_size=queue_size,
+            queue_bytes=queue_bytes,
+            overflow=overflow,
+            overflow_timeout=overflow_timeout,
+            spool=spool,
+            retry_policy=retry_policy,
+            circuit_breaker=circuit_breaker,
+            adaptive_sampler=adaptive_sampler,
+            serializer=serializer,
+            transport=transport,
+            max_in_flight=max_in_flight,
         )
 
         # parse specified rules
@@ -60,13 +106,89 @@ class HttpLogger(BaseLogger):
     def rules(self) -> HttpRules:
         return self._rules
 
-    def submit_if_passing(
-        self, details: List[List[str]], custom_fields: Optional[Dict[str, str]]
-    ) -> None:
-        # apply active rules
-        details = self._rules.apply(details)  # type: ignore
+    @property
+    def sample_rate(self) -> float:
+        """Percentage of messages currently kept by the sample rule, scaled down
+        by the adaptive sampler while under pressure."""
+        rate = self._rules.sample[0].param1 if self._rules.sample else 100
+        if self.adaptive_sampler is not None:
+            rate = rate * self.adaptive_sampler.rate / 100
+        return rate
+
+    def precheck(
+        self,
+        method: Optional[str],
+        url: Optional[str],
+        headers: Optional[Headers] = None,
+    ) -> bool:
+        """Checks whether a request could be logged at all, using only details
+        that are available before its body is read or its response is built, so
+        that middleware can skip capturing requests that would be stopped."""
+        if not self.enabled or self.skip_submission is True:
+            return False
+        if not self._rules.stops_early:
+            return True
+        return self._rules.precheck(self.__early_details(method, url, headers))
+
+    @property
+    def rate_limit_dropped(self) -> Dict[str, int]:
+        return self._rules.rate_limit_dropped
+
+    def sampled(
+        self,
+        method: Optional[str],
+        url: Optional[str],
+        headers: Optional[Headers] = None,
+        status=None,
+    ) -> bool:
+        """Decides whether sample rules keep a request, using the same details as
+        precheck plus the response code, so that dropped requests are never
+        built into messages. Rate limits are left to prepare_if_passing, so that
+        messages stopped by other rules don't use up their budget."""
+        scale = self.__sample_scale()
+        if not self._rules.samples and scale >= 1:
+            return True
+        details = self.__early_details(method, url, headers)
+        if status:
+            details.append(["response_code", str(status)])
+        return self._rules.sampled(details, scale)
+
+    def __sample_scale(self) -> float:
+        if self.adaptive_sampler is None:
+            return 1.0
+        return self.adaptive_sampler.update(self._queue_fill()) / 100
+
+    @staticmethod
+    def __early_details(
+        method: Optional[str], url: Optional[str], headers: Optional[Headers]
+    ) -> List[List[str]]:
+        details: List[List[str]] = []
+        if method:
+            details.append(["request_method", method])
+        if url:
+            details.append(["request_url", url])
+            details.extend(
+                [f"request_param:{k}".lower(), v[0]]
+                for k, v in parse.parse_qs(parse.urlsplit(url).query).items()
+            )
+        if headers:
+            pairs = headers.items() if isinstance(headers, Mapping) else headers
+            details.extend([f"request_header:{k}".lower(), v] for k, v in pairs)
+        return details
+
+    def prepare_if_passing(
+        self,
+        details: Details,
+        custom_fields: Optional[Dict[str, str]],
+        sample: bool = True,
+    ) -> Optional[Details]:
+        """Applies active rules and finalizes details into a message, returning
+        None if the rules stop it from being logged."""
+        if sample and not self._rules.sampled(details, self.__sample_scale()):
+            return None
+        details = self._rules.apply(details, sample=False)  # type: ignore
         if details is None:
-            return
+            return None
 
         # add custom fields
         if custom_fields:
@@ -80,6 +202,16 @@ class HttpLogger(BaseLogger):
 
         # finalize message
         details.append(["host", self.host])
+        return details
+
+    def submit_if_passing(
+        self,
+        details: Details,
+        custom_fields: Optional[Dict[str, str]],
+    ) -> None:
+        message = self.prepare_if_passing(details, custom_fields)
+        if message is None:
+            return
 
         # let's do this thing
-        self.submit(details)
+        self.submit(message)
@@ -2,10 +2,13 @@
 # © 2016-2024 Graylog, Inc.
 from re import match
 from time import time
-from typing import Dict, List, Optional
+from typing import Dict, Optional
 from urllib import parse
 
+from .http_details import DetailKind, HttpDetails
 from .http_logger import HttpLogger
+from .utils.capture import capture_body, header_value
+from .utils.multipart_decoder import decode_multipart
 
 
 class HttpMessage(object):
@@ -25,9 +28,51 @@ class HttpMessage(object):
         if not logger.enabled:
             return
 
+        message = cls.prepare(
+            logger,
+            request,
+            response,
+            response_body,
+            request_body,
+            now,
+            interval,
+            custom_fields,
+        )
+        if message is not None:
+            logger.submit(message)
+
+    @classmethod
+    def prepare(
+        cls,
+        logger: HttpLogger,
+        request,
+        response,
+        response_body: Optional[str] = None,
+        request_body: Optional[str] = None,
+        now=None,
+        interval=None,
+        custom_fields: Optional[Dict[str, str]] = None,
+    ) -> Optional[HttpDetails]:
+        """Builds the message to log, or returns None if the logger's rules stop
+        it from being logged."""
+
+        # decide sampling before copying anything
+        if not logger.sampled(
+            request.method,
+            str(request.url) if request.url else None,
+            request.headers,
+            getattr(response, "status", None) or getattr(response, "status_code", None),
+        ):
+            return None
+
         # copy details from request & response
-        message: List[List[str]] = cls.build(
-            request, response, response_body, request_body
+        message = cls.build(
+            request,
+            response,
+            response_body,
+            request_body,
+            request_body_limit=logger.rules.truncation("request_body"),
+            response_body_limit=logger.rules.truncation("response_body"),
         )
 
         # copy details from active session
@@ -42,16 +87,16 @@ class HttpMessage(object):
                                 d1 = d1.get_dict()
                             if isinstance(d1, dict):
                                 d1 = {k: v for k, v in d1.items() if v}
-                            message.append([f"session_field:{d0.lower()}", str(d1)])
+                            message.add(DetailKind.SESSION_FIELD, str(d1), d0.lower())
 
         # add timing details
-        message.append(
-            ["now", str(now) if now is not None else str(round(time() * 1000))]
+        message.add(
+            DetailKind.NOW, str(now) if now is not None else str(round(time() * 1000))
         )
         if interval is not None:
-            message.append(["interval", interval])
+            message.add(DetailKind.INTERVAL, interval)
 
-        logger.submit_if_passing(message, custom_fields)
+        return logger.prepare_if_passing(message, custom_fields, sample=False)
 
     @classmethod
     def build(  # noqa: C901
@@ -60,29 +105,29 @@ class HttpMessage(object):
         response,
         response_body: Optional[str] = None,
         request_body: Optional[str] = None,
-    ) -> List[List[str]]:  # sourcery no-metrics
+        request_body_limit: Optional[int] = None,
+        response_body_limit: Optional[int] = None,
+    ) -> HttpDetails:  # sourcery no-metrics
 
-        message: List[List[str]] = []
+        message = HttpDetails()
+        add = message.add
         address_in_header: bool = False
 
         if request.__class__.__name__ == "HttpRequestImpl":
-            message = []
             if request.method:
-                message.append(["request_method", request.method])
+                add(DetailKind.REQUEST_METHOD, request.method)
             if request.url:
-                message.append(["request_url", request.url])
+                add(DetailKind.REQUEST_URL, request.url)
             if response.status:
-                message.append(["response_code", str(response.status)])
+                add(DetailKind.RESPONSE_CODE, str(response.status))
 
             if request.remote_addr:
-                message.append(
-                    ["request_header: x-forwarded-for ", request.remote_addr]
-                )
+                add(DetailKind.REQUEST_HEADER, request.remote_addr, " x-forwarded-for ")
                 address_in_header = True
 
             for k, v in request.headers.items():
                 k = k.lower()
-                message.append([f"request_header:{k}", v])
+                add(DetailKind.REQUEST_HEADER, v, k)
                 if not address_in_header and k in [
                     "x-forwarded-for",
                     "forwarded-for",
@@ -98,56 +143,71 @@ class HttpMessage(object):
                     "x-real-ip",
                     "x-cluster-client-ip",
                 ]:
-                    message.append([f"request_header: x-forwarded-for {k}", v])
-
-            message.extend(
-                [f"request_param:{k}".lower(), v] for k, v in request.params.items()
-            )
+                    add(DetailKind.REQUEST_HEADER, v, f" x-forwarded-for {k}")
 
-            message.extend(
-                [f"response_header:{k}".lower(), v] for k, v in response.headers.items()
-            )
+            message.add_items(DetailKind.REQUEST_PARAM, request.params.items())
+            message.add_items(DetailKind.RESPONSE_HEADER, response.headers.items())
 
-            final_request_body = (
-                request_body if (request_body is not None) else request.body
-            )
+            # bodies given as bytes are decoded here, off the request path
+            request_type = header_value(request.headers, "content-type")
+            if request_body is None and "multipart/form-data" in str(request_type):
+                final_request_body = decode_multipart(
+                    request.body, request_type, request_body_limit
+                )
+            else:
+                final_request_body = capture_body(
+                    request_body if (request_body is not None) else request.body,
+                    request_type,
+                    request_body_limit,
+                    header_value(request.headers, "content-encoding"),
+                    request.body_size if request_body is None else None,
+                )
             if final_request_body:
-                message.append(["request_body", final_request_body])
-            final_response_body = (
-                response_body if (response_body is not None) else response.body
+                add(DetailKind.REQUEST_BODY, final_request_body)
+            final_response_body = capture_body(
+                response_body if (response_body is not None) else response.body,
+                header_value(response.headers, "content-type"),
+                response_body_limit,
+                header_value(response.headers, "content-encoding"),
+                response.body_size if response_body is None else None,
             )
             if final_response_body:
-                message.append(["response_body", final_response_body])
+                add(DetailKind.RESPONSE_BODY, final_response_body)
 
         elif request.__class__.__name__ == "PreparedRequest":
-            message = []
             if request.method:
-                message.append(["request_method", request.method])
+                add(DetailKind.REQUEST_METHOD, request.method)
 
             url = str(request.url)
             if url:
-                message.append(["request_url", url])
+                add(DetailKind.REQUEST_URL, url)
             if response.status_code:
-                message.append(["response_code", str(response.status_code)])
-            message.extend(
-                [f"request_header:{k}".lower(), v] for k, v in request.headers.items()
-            )
+                add(DetailKind.RESPONSE_CODE, str(response.status_code))
+            message.add_items(DetailKind.REQUEST_HEADER, request.headers.items())
 
             parsed_url = parse.parse_qs(parse.urlparse(url).query)
-            message.extend(
-                [f"request_param:{k}".lower(), v[0]] for k, v in parsed_url.items()
+            message.add_items(
+                DetailKind.REQUEST_PARAM, ((k, v[0]) for k, v in parsed_url.items())
             )
 
             if request.body:
-                body_ = request.body
-                if isinstance(body_, bytes):
-                    body_ = body_.decode()
-                message.append(["request_body", body_])
+                body_ = capture_body(
+                    request.body,
+                    request.headers.get("content-type"),
+                    request_body_limit,
+                )
+                if body_ is not None:
+                    add(DetailKind.REQUEST_BODY, body_)
 
-            message.extend(
-                [f"response_header:{k}".lower(), v] for k, v in response.headers.items()
-            )
+            message.add_items(DetailKind.RESPONSE_HEADER, response.headers.items())
 
-            message.append(["response_body", response.content.decode("utf8")])
+            # requests has already undone any content encoding
+            content = capture_body(
+                response.content,
+                response.headers.get("content-type"),
+                response_body_limit,
+            )
+            if content is not None:
+                add(DetailKind.RESPONSE_BODY, content)
 
         return message
@@ -1,7 +1,7 @@
 # coding: utf-8
 # © 2016-2024 Graylog, Inc.
 
-from typing import Dict, Optional
+from typing import Dict, Optional, Union
 
 
 class HttpRequestImpl(object):
@@ -11,8 +11,9 @@ class HttpRequestImpl(object):
         url: Optional[str] = None,
         headers: Optional[Dict[str, str]] = None,
         params: Optional[Dict[str, str]] = None,
-        body: Optional[str] = None,
+        body: Union[str, bytes, None] = None,
         remote_addr: Optional[str] = None,
+        body_size: Optional[int] = None,
     ) -> None:
         self.method = method
         self.url = url
@@ -20,3 +21,4 @@ class HttpRequestImpl(object):
         self.params = {} if params is None else params
         self.body = body
         self.remote_addr = remote_addr
+        self.body_size = body_size  # of the whole body, if body is only its start
@@ -1,7 +1,7 @@
 # coding: utf-8
 # © 2016-2024 Graylog, Inc.
 
-from typing import Dict, Optional
+from typing import Dict, Optional, Union
 
 
 class HttpResponseImpl(object):
@@ -9,8 +9,10 @@ class HttpResponseImpl(object):
         self,
         status: Optional[int] = None,
         headers: Optional[Dict[str, str]] = None,
-        body: Optional[str] = None,
+        body: Union[str, bytes, None] = None,
+        body_size: Optional[int] = None,
     ) -> None:
         self.status = status
         self.headers = {} if headers is None else headers
         self.body = body
+        self.body_size = body_size  # of the whole body, if body is only its start
@@ -8,8 +8,8 @@ class HttpRule(object):
         self,
         verb: str,
         scope: Optional[Pattern] = None,
-        param1: Optional[Union[Pattern, str, int]] = None,
-        param2: Optional[Union[Pattern, str]] = None,
+        param1: Optional[Union[Pattern, str, float]] = None,
+        param2: Optional[Union[Pattern, str, float]] = None,
     ) -> None:
         self._verb = verb
         self._scope = scope
@@ -1,12 +1,19 @@
 # coding: utf-8
 # © 2016-2024 Graylog, Inc.
 
+import functools
 import random
 import re
+import threading
+import zlib
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Optional, Pattern, Sized
+from typing import Dict, List, Optional, Pattern, Sized, Tuple, Union
 
+from usagelogger.http_details import PREFIXES, HttpDetails
 from usagelogger.http_rule import HttpRule
+from usagelogger.token_bucket import TokenBucket
+from usagelogger.utils.capture import truncate_text
 
 
 class HttpRules(Sized):
@@ -69,6 +76,14 @@ class HttpRules(Sized):
             return HttpRule(
                 "copy_session_field", None, HttpRules.parse_regex(rule, m.group(1))
             )
+        m = HttpRules.__REGEX_RATE_LIMIT.match(rule)
+        if m:
+            return HttpRule(
+                "rate_limit",
+                HttpRules.parse_regex(rule, m.group(1)) if m.group(1) else None,
+                HttpRules.parse_rate(rule, m.group(2), m.group(3)),
+                float(m.group(2)),
+            )
         m = HttpRules.__REGEX_REMOVE.match(rule)
         if m:
             return HttpRule("remove", HttpRules.parse_regex(rule, m.group(1)))
@@ -114,12 +129,33 @@ class HttpRules(Sized):
             if m1 < 1 or m1 > 99:
                 raise SyntaxError("Invalid sample percent: " + m.group(1))
             return HttpRule("sample", None, m1)
+        m = HttpRules.__REGEX_SAMPLE_BY.match(rule)
+        if m:
+            return HttpRule("sample_by", None, HttpRules.parse_regex(rule, m.group(1)))
+        m = HttpRules.__REGEX_SAMPLE_IF.match(rule)
+        if m:
+            m3 = int(m.group(3))
+            if m3 < 1 or m3 > 100:
+                raise SyntaxError("Invalid sample percent: " + m.group(3))
+            return HttpRule(
+                "sample_if",
+                HttpRules.parse_regex(rule, m.group(1)),
+                HttpRules.parse_regex(rule, m.group(2)),
+                m3,
+            )
         m = HttpRules.__REGEX_SKIP_COMPRESSION.match(rule)
         if m:
             return HttpRule("skip_compression")
         m = HttpRules.__REGEX_SKIP_SUBMISSION.match(rule)
         if m:
             return HttpRule("skip_submission")
+        m = HttpRules.__REGEX_TRUNCATE.match(rule)
+        if m:
+            return HttpRule(
+                "truncate",
+                HttpRules.parse_regex(rule, m.group(1)),
+                HttpRules.parse_size(rule, m.group(2), m.group(3)),
+            )
         m = HttpRules.__REGEX_STOP.match(rule)
         if m:
             return HttpRule("stop", HttpRules.parse_regex(rule, m.group(1)))
@@ -174,6 +210,22 @@ class HttpRules(Sized):
         except Exception:
             raise SyntaxError(f"Invalid regex ({regex}) in rule: {rule}")
 
+    @classmethod
+    def parse_rate(cls, rule: str, count: str, unit: str) -> float:
+        """Parses rate limit into events per second."""
+        rate = float(count) / {"s": 1, "m": 60, "h": 3600}[unit]
+        if rate <= 0:
+            raise SyntaxError(f"Invalid rate ({count}/{unit}) in rule: {rule}")
+        return rate
+
+    @classmethod
+    def parse_size(cls, rule: str, count: str, unit: str) -> int:
+        """Parses size limit into bytes."""
+        size = int(count) * {"": 1, "k": 1024, "m": 1024 * 1024}[unit.lower()]
+        if size <= 0:
+            raise SyntaxError(f"Invalid size ({count}{unit}) in rule: {rule}")
+        return size
+
     @classmethod
     def parse_string(cls, rule: str, expr: str) -> str:
         """Parses delimited string expression."""
@@ -188,7 +240,7 @@ class HttpRules(Sized):
                 return sep.join(m1.split("\\" + sep))
         raise SyntaxError(f"Invalid expression ({expr}) in rule: {rule}")
 
-    def __init__(self, rules: str) -> None:
+    def __init__(self, rules: str, cache_size: int = 1024) -> None:
         if rules is None:
             rules = HttpRules.default_rules()
 
@@ -244,8 +296,11 @@ class HttpRules(Sized):
         self._remove_unless_found: List[HttpRule] = [
             r for r in prs if "remove_unless_found" == r.verb
         ]
+        self._rate_limit: List[HttpRule] = [r for r in prs if "rate_limit" == r.verb]
         self._replace: List[HttpRule] = [r for r in prs if "replace" == r.verb]
         self._sample: List[HttpRule] = [r for r in prs if "sample" == r.verb]
+        self._sample_by: List[HttpRule] = [r for r in prs if "sample_by" == r.verb]
+        self._sample_if: List[HttpRule] = [r for r in prs if "sample_if" == r.verb]
         self._skip_compression: bool = (
             len([r for r in prs if r.verb == "skip_compression"]) > 0
         )
@@ -253,6 +308,7 @@ class HttpRules(Sized):
             len([r for r in prs if r.verb == "skip_submission"]) > 0
         )
         self._stop: List[HttpRule] = [r for r in prs if "stop" == r.verb]
+        self._truncate: List[HttpRule] = [r for r in prs if "truncate" == r.verb]
         self._stop_if: List[HttpRule] = [r for r in prs if "stop_if" == r.verb]
         self._stop_if_found: List[HttpRule] = [
             r for r in prs if "stop_if_found" == r.verb
@@ -266,6 +322,27 @@ class HttpRules(Sized):
         if len(self._sample) > 1:
             raise SyntaxError("Multiple sample rules")
 
+        # compile execution plan, matching each distinct scope only once
+        self._order: Dict[HttpRule, int] = {r: i for i, r in enumerate(prs)}
+        scopes: Dict[Pattern, List[HttpRule]] = {}
+        for r in prs:
+            if r.verb in _DetailPlan.VERBS:
+                scopes.setdefault(r.scope, []).append(r)
+        self._scopes: List[Tuple[Pattern, List[HttpRule]]] = list(scopes.items())
+
+        self._samples = bool(self._sample or self._sample_if)
+        self._stops_early = bool(self._stop or self._stop_if or self._stop_if_found)
+
+        # remember plans for recently seen detail keys, bounded since header
+        # and param names come from clients
+        self._plan = functools.lru_cache(maxsize=cache_size)(self._resolve)
+
+        # rate limits keep a token bucket per rule and scope value, bounded
+        # like the plan cache since scope values come from clients
+        self._buckets: "OrderedDict[Tuple[int, str], TokenBucket]" = OrderedDict()
+        self._buckets_lock = threading.Lock()
+        self._buckets_size = cache_size
+
     def __len__(self) -> int:
         return self._length
 
@@ -297,6 +374,22 @@ class HttpRules(Sized):
     def remove_unless_found(self) -> List[HttpRule]:
         return self._remove_unless_found
 
+    @property
+    def rate_limit(self) -> List[HttpRule]:
+        return self._rate_limit
+
+    @property
+    def rate_limit_dropped(self) -> Dict[str, int]:
+        """Messages dropped by rate_limit rules, for recently seen scopes. Keys
+        are the detail that scoped rules matched, like request_url:/login, or *
+        for unscoped rules."""
+        dropped: Dict[str, int] = {}
+        with self._buckets_lock:
+            for (_, key), bucket in self._buckets.items():
+                if bucket.dropped:
+                    dropped[key] = dropped.get(key, 0) + bucket.dropped
+        return dropped
+
     @property
     def replace(self) -> List[HttpRule]:
         return self._replace
@@ -305,6 +398,19 @@ class HttpRules(Sized):
     def sample(self) -> List[HttpRule]:
         return self._sample
 
+    @property
+    def sample_by(self) -> List[HttpRule]:
+        return self._sample_by
+
+    @property
+    def sample_if(self) -> List[HttpRule]:
+        return self._sample_if
+
+    @property
+    def samples(self) -> bool:
+        """True if any rules can sample messages down."""
+        return self._samples
+
     @property
     def skip_compression(self) -> bool:
         return self._skip_compression
@@ -333,87 +439,207 @@ class HttpRules(Sized):
     def stop_unless_found(self) -> List[HttpRule]:
         return self._stop_unless_found
 
+    @property
+    def truncate(self) -> List[HttpRule]:
+        return self._truncate
+
     @property
     def text(self) -> str:
         return self._text
 
-    def apply(self, details: List[List[str]]) -> Optional[List[List[str]]]:
-        # stop rules come first
-        for r in self._stop:
-            for d in details:
-                if r.scope.match(d[0]):
+    def apply(
+        self, details: Union[HttpDetails, List[List[str]]], sample: bool = True
+    ) -> Union[HttpDetails, List[List[str]], None]:
+        """Applies stop, sample, rate_limit, remove and replace rules to message
+        details in a single pass, returning None if the message should not be
+        logged. Sampling is skipped if the caller already made that decision,
+        while rate_limit tokens are only taken once stop rules pass. HttpDetails
+        are redacted in place, while a list of details gives a new list."""
+        if not isinstance(details, HttpDetails):
+            result = self.apply(HttpDetails.of(details), sample)
+            return None if result is None else result.to_list()  # type: ignore
+
+        plan_for = self._plan
+        prefixes = PREFIXES
+        values = details.values
+        kept = []
+        passed_found = 0
+        passed = 0
+        for i, (kind, name) in enumerate(zip(details.kinds, details.names)):
+            plan = plan_for(prefixes[kind] if name is None else prefixes[kind] + name)
+            if plan.inert:
+                kept.append((i, plan))
+                continue
+            value = values[i]
+
+            # cut oversized values before any other rules scan them
+            if plan.truncate is not None and len(value) * 4 > plan.truncate:
+                value = values[i] = truncate_text(value, plan.truncate)
+
+            # stop rules come first
+            if plan.stop:
+                return None
+            for p in plan.stop_if_found:
+                if p.search(value):
                     return None
-        for r in self._stop_if_found:
-            for d in details:
-                if r.scope.match(d[0]) and r.param1.search(d[1]):
+            for p in plan.stop_if:
+                if p.match(value):
                     return None
-        for r in self._stop_if:
-            for d in details:
-                if r.scope.match(d[0]) and r.param1.match(d[1]):
-                    return None
-        passed = 0
-        for r in self._stop_unless_found:
-            for d in details:
-                if r.scope.match(d[0]) and r.param1.search(d[1]):
+            for p in plan.stop_unless_found:
+                if p.search(value):
+                    passed_found += 1
+            for p in plan.stop_unless:
+                if p.match(value):
                     passed += 1
-        if passed != len(self._stop_unless_found):
-            return None
-        passed = 0
-        for r in self._stop_unless:
-            for d in details:
-                if r.scope.match(d[0]) and r.param1.match(d[1]):
-                    passed += 1
-        if passed != len(self._stop_unless):
-            return None
 
-        # do sampling if configured
-        if len(self._sample) == 1 and random.randrange(100) >= int(
-            self._sample[0].param1
+            # winnow sensitive details based on remove rules if configured
+            if (
+                plan.remove
+                or any(not p.search(value) for p in plan.remove_unless_found)
+                or any(p.search(value) for p in plan.remove_if_found)
+                or any(not p.match(value) for p in plan.remove_unless)
+                or any(p.match(value) for p in plan.remove_if)
+            ):
+                continue
+            kept.append((i, plan))
+
+        if passed_found != len(self._stop_unless_found) or passed != len(
+            self._stop_unless
         ):
             return None
 
-        # winnow sensitive details based on remove rules if configured
-        for r in self._remove:
-            for d in details:
-                if r.scope.match(d[0]):
-                    d[1] = ""
-        for r in self._remove_unless_found:
-            for d in details:
-                if r.scope.match(d[0]) and not r.param1.search(d[1]):
-                    d[1] = ""
-        for r in self._remove_if_found:
-            for d in details:
-                if r.scope.match(d[0]) and r.param1.search(d[1]):
-                    d[1] = ""
-        for r in self._remove_unless:
-            for d in details:
-                if r.scope.match(d[0]) and not r.param1.match(d[1]):
-                    d[1] = ""
-        for r in self._remove_if:
-            for d in details:
-                if r.scope.match(d[0]) and r.param1.match(d[1]):
-                    d[1] = ""
-
-        # remove any details with empty values
-        details = [x for x in details if x[1] != ""]
-        if not details:
+        # do sampling if configured
+        if sample and self._samples and not self.sampled(details):
+            return None
+        if self._rate_limit and self.rate_limited(details):
             return None
 
-        # mask sensitive details based on replace rules if configured
-        for r in self._replace:
+        # mask sensitive details based on replace rules if configured, and
+        # remove any details with empty values
+        retained = []
+        for i, plan in kept:
+            value = values[i]
+            if value == "":
+                continue
+            for p, r in plan.replace:
+                value = p.sub(r, value)
+            if value != "":
+                values[i] = value
+                retained.append(i)
+        details.retain(retained)
+        return details if retained else None
+
+    def precheck(self, details: List[List[str]]) -> bool:
+        """Evaluates stop rules against details known before a request is fully
+        captured, like its method, URL and headers. Returns False if the message
+        would certainly be stopped. Rules that stop unless something is found
+        need the complete message, so these are left to apply."""
+        if not self._stops_early:
+            return True
+        for d in details:
+            plan = self._plan(d[0])
+            if plan.inert:
+                continue
+            if plan.stop:
+                return False
+            value = d[1]
+            for p in plan.stop_if_found:
+                if p.search(value):
+                    return False
+            for p in plan.stop_if:
+                if p.match(value):
+                    return False
+        return True
+
+    def sampled(
+        self, details: Union[HttpDetails, List[List[str]]], scale: float = 1.0
+    ) -> bool:
+        """Decides whether sample rules keep a message. The rate comes from the
+        first sample_if rule matching any detail, else from the sample rule, and
+        is multiplied by the given scale. The decision hashes the value of the
+        first detail matched by sample_by rules (in rule order) so that it is the
+        same wherever that value is seen, and is random if no such detail is
+        present."""
+        if not self._samples and scale >= 1:
+            return True
+        rate = self._sample[0].param1 if self._sample else 100
+        for r in self._sample_if:
+            if any(r.scope.match(d[0]) and r.param1.match(d[1]) for d in details):
+                rate = r.param2
+                break
+        rate *= scale
+        if rate >= 100:
+            return True
+        for r in self._sample_by:
             for d in details:
-                if r.scope.match(d[0]):
-                    d[1] = re.sub(r.param1, r.param2, d[1])
+                if r.param1.match(d[0]):
+                    return zlib.crc32(d[1].encode("utf-8")) % 10000 < rate * 100
+        return random.random() * 100 < rate
+
+    def rate_limited(self, details: Union[HttpDetails, List[List[str]]]) -> bool:
+        """Takes a token for a message from each rate_limit rule, returning True
+        if the message should be dropped. Scoped rules limit each value of the
+        first detail their scope matches separately, and don't apply to
+        messages without such a detail."""
+        for r in self._rate_limit:
+            if r.scope is None:
+                key = "*"
+            else:
+                d = next((d for d in details if r.scope.match(d[0])), None)
+                if d is None:
+                    continue
+                key = f"{d[0]}:{d[1]}"
+            if not self.__bucket(r, key).take():
+                return True
+        return False
+
+    def __bucket(self, rule: HttpRule, key: str) -> TokenBucket:
+        k = (self._order[rule], key)
+        with self._buckets_lock:
+            bucket = self._buckets.get(k)
+            if bucket is None:
+                # allow a burst of at least one message, or rates below one
+                # per time unit would never admit any
+                bucket = self._buckets[k] = TokenBucket(
+                    rule.param1, max(1.0, rule.param2)
+                )
+                if len(self._buckets) > self._buckets_size:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(k)
+            return bucket
+
+    def truncation(self, key: str) -> Optional[int]:
+        """Size that truncate rules cap the given detail to, if any, so that
+        middleware can avoid capturing more of a body than will be logged."""
+        return self._plan(key).truncate if self._truncate else None
 
-        # remove any details with empty values
-        details = [x for x in details if x[1] != ""]
-        return None if not details else details
+    @property
+    def stops_early(self) -> bool:
+        """True if any rules can be evaluated by precheck."""
+        return self._stops_early
+
+    @property
+    def cache_info(self):
+        """Hits, misses and size of the detail key to plan cache."""
+        return self._plan.cache_info()
+
+    def _resolve(self, key: str) -> "_DetailPlan":
+        """Resolves which rules apply to the given detail key."""
+        rules: List[HttpRule] = []
+        for scope, scoped_rules in self._scopes:
+            if scope.match(key):
+                rules.extend(scoped_rules)
+        return _DetailPlan(sorted(rules, key=self._order.__getitem__))
 
     __REGEX_ALLOW_HTTP_URL: Pattern = re.compile(r"^\s*allow_http_url\s*(#.*)?$")
     __REGEX_BLANK_OR_COMMENT: Pattern = re.compile(r"^\s*([#].*)*$")
     __REGEX_COPY_SESSION_FIELD: Pattern = re.compile(
         r"^\s*copy_session_field\s+([~!%|/].+[~!%|/])\s*(#.*)?$"
     )
+    __REGEX_RATE_LIMIT: Pattern = re.compile(
+        r"^\s*([~!%|/].+[~!%|/])?\s*" r"rate_limit\s+(\d+(?:\.\d+)?)/(s|m|h)\s*(#.*)?$"
+    )
     __REGEX_REMOVE: Pattern = re.compile(r"^\s*([~!%|/].+[~!%|/])\s*remove\s*(#.*)?$")
     __REGEX_REMOVE_IF: Pattern = re.compile(
         r"^\s*([~!%|/].+[~!%|/])\s*remove_if\s+([~!%|/].+[~!%|/])\s*(#.*)?$"
@@ -433,8 +659,17 @@ class HttpRules(Sized):
         r"replace[\s]+([~!%|/].+[~!%|/]),[\s]+([~!%|/].*[~!%|/])\s*(#.*)?$"
     )
     __REGEX_SAMPLE: Pattern = re.compile(r"^\s*sample\s+(\d+)\s*(#.*)?$")
+    __REGEX_SAMPLE_BY: Pattern = re.compile(
+        r"^\s*sample_by\s+([~!%|/].+[~!%|/])\s*(#.*)?$"
+    )
+    __REGEX_SAMPLE_IF: Pattern = re.compile(
+        r"^\s*([~!%|/].+[~!%|/])\s*" r"sample_if\s+([~!%|/].+[~!%|/])\s+(\d+)\s*(#.*)?$"
+    )
     __REGEX_SKIP_COMPRESSION: Pattern = re.compile(r"^\s*skip_compression\s*(#.*)?$")
     __REGEX_SKIP_SUBMISSION: Pattern = re.compile(r"^\s*skip_submission\s*(#.*)?$")
+    __REGEX_TRUNCATE: Pattern = re.compile(
+        r"^\s*([~!%|/].+[~!%|/])\s*truncate\s+(\d+)([kKmM]?)\s*(#.*)?$"
+    )
     __REGEX_STOP: Pattern = re.compile(r"^\s*([~!%|/].+[~!%|/])\s*stop\s*(#.*)?$")
     __REGEX_STOP_IF: Pattern = re.compile(
         r"^\s*([~!%|/].+[~!%|/])\s*stop_if\s+([~!%|/].+[~!%|/])\s*(#.*)?$"
@@ -448,3 +683,59 @@ class HttpRules(Sized):
     __REGEX_STOP_UNLESS_FOUND: Pattern = re.compile(
         r"^\s*([~!%|/].+[~!%|/])\s*" r"stop_unless_found\s+([~!%|/].+[~!%|/])\s*(#.*)?$"
     )
+
+
+class _DetailPlan(object):
+    """Rules applicable to one detail key, grouped by what they do."""
+
+    VERBS = (
+        "remove",
+        "remove_if",
+        "remove_if_found",
+        "remove_unless",
+        "remove_unless_found",
+        "replace",
+        "stop",
+        "stop_if",
+        "stop_if_found",
+        "stop_unless",
+        "stop_unless_found",
+        "truncate",
+    )
+
+    __slots__ = (
+        "inert",
+        "remove",
+        "remove_if",
+        "remove_if_found",
+        "remove_unless",
+        "remove_unless_found",
+        "replace",
+        "stop",
+        "stop_if",
+        "stop_if_found",
+        "stop_unless",
+        "stop_unless_found",
+        "truncate",
+    )
+
+    def __init__(self, rules: List[HttpRule]) -> None:
+        self.inert = not rules
+        self.remove = any(r.verb == "remove" for r in rules)
+        self.remove_if = [r.param1 for r in rules if r.verb == "remove_if"]
+        self.remove_if_found = [r.param1 for r in rules if r.verb == "remove_if_found"]
+        self.remove_unless = [r.param1 for r in rules if r.verb == "remove_unless"]
+        self.remove_unless_found = [
+            r.param1 for r in rules if r.verb == "remove_unless_found"
+        ]
+        self.replace = [(r.param1, r.param2) for r in rules if r.verb == "replace"]
+        self.stop = any(r.verb == "stop" for r in rules)
+        self.stop_if = [r.param1 for r in rules if r.verb == "stop_if"]
+        self.stop_if_found = [r.param1 for r in rules if r.verb == "stop_if_found"]
+        self.stop_unless = [r.param1 for r in rules if r.verb == "stop_unless"]
+        self.stop_unless_found = [
+            r.param1 for r in rules if r.verb == "stop_unless_found"
+        ]
+        self.truncate = min(
+            (r.param1 for r in rules if r.verb == "truncate"), default=None
+        )
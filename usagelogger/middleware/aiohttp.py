@@ -3,38 +3,37 @@ from typing import Optional
 
 from aiohttp import web
 
-from usagelogger import HttpLogger, HttpMessage
+from usagelogger import AsyncHttpLogger
 from usagelogger.http_request_impl import HttpRequestImpl
 from usagelogger.http_response_impl import HttpResponseImpl
-from usagelogger.utils.multipart_decoder import decode_multipart
 
 
 def HttpLoggerForAIOHTTP(url: Optional[str] = None, rules: Optional[str] = None):
-    logger = HttpLogger(url=url, rules=rules)
+    logger = AsyncHttpLogger(url=url, rules=rules)
 
     @web.middleware
     async def resurface_logger_middleware(request, handler):
+        if not logger.precheck(request.method, str(request.url), request.headers):
+            return await handler(request)
+
         start_time = time.time()
         response = await handler(request)
 
         interval = str((time.time() - start_time) * 1000)
-        data__: bytes = await request.read()
-
-        is_multipart = "multipart/form-data" in str(request.headers.get("Content-Type"))
-        HttpMessage.send(
-            logger,
+        # bodies are decoded when the logger builds the message, off the loop
+        logger.enqueue(
             request=HttpRequestImpl(
                 url=str(request.url),
                 headers=request.headers,
                 params=request.query,
                 method=request.method,
-                body=decode_multipart(data__) if is_multipart else data__.decode(),
+                body=await request.read(),
                 remote_addr=request.remote_addr or None,
             ),
             response=HttpResponseImpl(
                 status=response.status,
                 headers=response.headers,
-                body=response.body.decode("utf8"),
+                body=response.body,
             ),
             interval=interval,
         )
@@ -0,0 +1,150 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import time
+from typing import Dict, List, Optional, Tuple, Union
+from urllib import parse
+
+from usagelogger import AsyncHttpLogger
+from usagelogger.http_request_impl import HttpRequestImpl
+from usagelogger.http_response_impl import HttpResponseImpl
+from usagelogger.utils.capture import CaptureBuffer
+from usagelogger.utils.multipart_decoder import MultipartDecoder, multipart_boundary
+
+
+class HttpLoggerForASGI:
+    """ASGI middleware for Starlette, FastAPI and other ASGI frameworks. Request
+    and response bodies are copied into bounded buffers as they stream through,
+    and the message is handed to the logger's background task once the last
+    response body chunk has been sent."""
+
+    def __init__(self, app, url: Optional[str] = None, rules: Optional[str] = None):
+        self.app = app
+        self.logger = AsyncHttpLogger(url=url, rules=rules)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method: str = scope.get("method", "GET")
+        headers = self.decode_headers(scope.get("headers", []))
+        url = self.request_url(scope, headers)
+        if not self.logger.precheck(method, url, headers):
+            return await self.app(scope, receive, send)
+
+        start_time = time.time()
+        request_body = self.request_buffer(headers.get("content-type"))
+        response_body = CaptureBuffer(self.logger.rules.truncation("response_body"))
+        status_: List[int] = []
+        response_headers: Dict[str, str] = {}
+
+        async def _receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                request_body.write(message.get("body", b""))
+            return message
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status_[:] = [message["status"]]
+                response_headers.update(self.decode_headers(message.get("headers", [])))
+            elif message["type"] == "http.response.body":
+                response_body.write(message.get("body", b""))
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                self.log(
+                    scope,
+                    method,
+                    url,
+                    headers,
+                    request_body,
+                    status_[0] if status_ else None,
+                    response_headers,
+                    response_body,
+                    str((time.time() - start_time) * 1000),
+                )
+
+        await self.app(scope, _receive, _send)
+
+    def log(
+        self,
+        scope,
+        method: str,
+        url: str,
+        headers: Dict[str, str],
+        request_body: Union[CaptureBuffer, MultipartDecoder],
+        status: Optional[int],
+        response_headers: Dict[str, str],
+        response_body: CaptureBuffer,
+        interval: str,
+    ) -> None:
+        # captured bytes are decoded when the logger builds the message, off
+        # the event loop; uploads were already reduced to their text fields
+        body: Union[str, bytes]
+        body_size: Optional[int] = None
+        if isinstance(request_body, MultipartDecoder):
+            body = request_body.getvalue()
+        else:
+            body, body_size = request_body.getvalue(), request_body.size
+        client = scope.get("client")
+        self.logger.enqueue(
+            request=HttpRequestImpl(
+                method=method,
+                url=url,
+                headers=headers,
+                params={
+                    k: v[0]
+                    for k, v in parse.parse_qs(
+                        scope.get("query_string", b"").decode("latin-1")
+                    ).items()
+                },
+                body=body,
+                remote_addr=client[0] if client else None,
+                body_size=body_size,
+            ),
+            response=HttpResponseImpl(
+                status=status,
+                headers=response_headers,
+                body=response_body.getvalue(),
+                body_size=response_body.size,
+            ),
+            interval=interval,
+        )
+
+    def request_buffer(
+        self, content_type: Optional[str]
+    ) -> Union[CaptureBuffer, MultipartDecoder]:
+        """Uploads are decoded as they stream in, so that only their text fields
+        are held in memory."""
+        limit = self.logger.rules.truncation("request_body")
+        if "multipart/form-data" in str(content_type):
+            return MultipartDecoder(multipart_boundary(content_type), limit)
+        return CaptureBuffer(limit)
+
+    @staticmethod
+    def decode_headers(raw: List[Tuple[bytes, bytes]]) -> Dict[str, str]:
+        """Decodes ASGI header pairs, joining repeated headers with commas."""
+        headers: Dict[str, str] = {}
+        for k, v in raw:
+            name = k.decode("latin-1").lower()
+            value = v.decode("latin-1")
+            headers[name] = f"{headers[name]}, {value}" if name in headers else value
+        return headers
+
+    @staticmethod
+    def request_url(scope, headers: Dict[str, str]) -> str:
+        scheme = scope.get("scheme", "http")
+        host = headers.get("host")
+        if not host and scope.get("server"):
+            name, port = scope["server"]
+            default = {"http": 80, "https": 443}.get(scheme)
+            host = name if port in (None, default) else f"{name}:{port}"
+        path = scope.get("raw_path")
+        path = (
+            path.decode("latin-1")
+            if path
+            else parse.quote(scope.get("root_path", "") + scope.get("path", ""))
+        )
+        query = scope.get("query_string", b"").decode("latin-1")
+        return f"{scheme}://{host}{path}" + (f"?{query}" if query else "")
@@ -1,14 +1,27 @@
 # coding: utf-8
 # © 2016-2024 Graylog, Inc.
+import asyncio
 import time
 
+from asgiref import sync
 from django.conf import settings
 from django.http.request import RawPostDataException
 
 from usagelogger import HttpLogger, HttpMessage, HttpRequestImpl, HttpResponseImpl
+from usagelogger.utils.capture import capture_body, decode_body
 from usagelogger.utils.multipart_decoder import decode_multipart
 
 
+def _mark_coroutine(func):
+    func._is_coroutine = asyncio.coroutines._is_coroutine
+    return func
+
+
+# asgiref < 3.6 has neither, so fall back to how asyncio marks coroutines
+iscoroutinefunction = getattr(sync, "iscoroutinefunction", asyncio.iscoroutinefunction)
+markcoroutinefunction = getattr(sync, "markcoroutinefunction", _mark_coroutine)
+
+
 def __read_settings__(key):
     try:
         return settings.USAGELOGGER[key]
@@ -17,48 +30,116 @@ def __read_settings__(key):
 
 
 class HttpLoggerForDjango:
+    """Middleware for both WSGI and ASGI Django. Requests only capture
+    references to what will be logged, and the message is built and filtered
+    by rules later on the logger's submission worker."""
+
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
         self.logger = HttpLogger(
             url=__read_settings__("url"), rules=__read_settings__("rules")
         )
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def prepare_request_body(self, request, response=None):
 
         is_multipart = request.content_type == "multipart/form-data"
+        limit = self.logger.rules.truncation("request_body")
 
         try:
             if response is None:
                 if is_multipart:
-                    body = decode_multipart(request.body)
+                    body = decode_multipart(
+                        request.body, request.META.get("CONTENT_TYPE"), limit
+                    )
                 else:
-                    body = request.body.decode()
+                    body = capture_body(
+                        request.body,
+                        request.META.get("CONTENT_TYPE"),
+                        limit,
+                        request.META.get("HTTP_CONTENT_ENCODING"),
+                    )
             else:
-                body = str(response.renderer_context["request"].data)
+                body = decode_body(
+                    str(response.renderer_context["request"].data), limit
+                )
         except (RawPostDataException, AttributeError):
             body = None
 
         return body
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.precheck(request):
+            return self.get_response(request)
+
         start_time = time.time()
-        request_body = self.prepare_request_body(request)
+        self.read_body(request)
         response = self.get_response(request)
-        interval = str((time.time() - start_time) * 1000)
-        method = request.method
+        self.defer(request, response, start_time)
+        return response
 
+    async def __acall__(self, request):
+        if not self.precheck(request):
+            return await self.get_response(request)
+
+        start_time = time.time()
+        self.read_body(request)
+        response = await self.get_response(request)
+        self.defer(request, response, start_time)
+        return response
+
+    def precheck(self, request) -> bool:
+        return self.logger.precheck(
+            request.method, request.build_absolute_uri(), request.headers
+        )
+
+    @staticmethod
+    def read_body(request) -> None:
+        """Reads the request body before the view can consume its stream."""
+        try:
+            request.body
+        except RawPostDataException:
+            pass
+
+    def defer(self, request, response, start_time: float) -> None:
+        end_time = time.time()
+        interval = str((end_time - start_time) * 1000)
+        now = str(round(end_time * 1000))
+        try:
+            size = len(request.body) + len(response.content)
+        except (RawPostDataException, AttributeError):
+            size = 0
+        self.logger.submit_deferred(
+            lambda: self.build(request, response, interval, now), size
+        )
+
+    def build(self, request, response, interval: str, now=None):
+        """Builds the message to log, or returns None if rules stop it."""
+        method = request.method
+        request_body = self.prepare_request_body(request)
         if request_body is None:
             request_body = self.prepare_request_body(request, response)
 
         try:
             if response.content:
-                response_body = str(response.content.decode("utf8"))
+                response_body = capture_body(
+                    response.content,
+                    response.get("Content-Type"),
+                    self.logger.rules.truncation("response_body"),
+                    response.get("Content-Encoding"),
+                )
             else:
                 response_body = None
         except AttributeError:
             response_body = None
 
-        HttpMessage.send(
+        return HttpMessage.prepare(
             self.logger,
             request=HttpRequestImpl(
                 method=method,
@@ -75,6 +156,6 @@ class HttpLoggerForDjango:
                 body=response_body,
                 headers=response,
             ),
+            now=now,
             interval=interval,
         )
-        return response
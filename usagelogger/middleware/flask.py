@@ -2,38 +2,60 @@
 # © 2016-2024 Graylog, Inc.
 import time
 from io import BytesIO
-from typing import Dict, Iterable, List, Optional, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from urllib import parse
 
 from werkzeug.wrappers import Request
-from werkzeug.wsgi import ClosingIterator
 
 from usagelogger import HttpLogger, HttpMessage, HttpRequestImpl, HttpResponseImpl
+from usagelogger.utils.capture import CaptureBuffer, capture_body, header_value
 from usagelogger.utils.multipart_decoder import decode_multipart
 
 
+class StreamingResponse:
+    """Passes a WSGI response through chunk by chunk as the server asks for it,
+    copying its start into a bounded buffer, and calls `on_close` with that
+    buffer once the server closes the response."""
+
+    def __init__(
+        self,
+        response: Iterable[bytes],
+        buffer: CaptureBuffer,
+        on_close: Callable[[CaptureBuffer], None],
+    ) -> None:
+        self._response = response
+        self._chunks: Iterator[bytes] = iter(response)
+        self._buffer = buffer
+        self._on_close: Optional[Callable[[CaptureBuffer], None]] = on_close
+
+    def __iter__(self) -> "StreamingResponse":
+        return self
+
+    def __next__(self) -> bytes:
+        chunk = next(self._chunks)
+        self._buffer.write(chunk)
+        return chunk
+
+    def close(self) -> None:
+        try:
+            if hasattr(self._response, "close"):
+                self._response.close()  # type: ignore
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close(self._buffer)
+
+
 class HttpLoggerForFlask:
     def __init__(self, app, url: Optional[str] = None, rules: Optional[str] = None):
         self.app = app
         self.logger = HttpLogger(url=url, rules=rules)
-        self.start_time: float = 0.0
-        self.interval: float = 0.0
-        self.response: List[bytes] = []
-        self.response_headers: Iterable[Tuple[str, str]] = []
-        self.status: Optional[int] = None
-
-    def start_response(
-        self, status: str, response_headers: Iterable[Tuple[str, str]]
-    ) -> None:
-        self.start_time = time.time()
-        self.status = int(status.split(" ")[0])
-        self.response_headers = response_headers
 
-    def finish_response(self, response: ClosingIterator) -> List[bytes]:
-        self.interval = 1000.0 * (time.time() - self.start_time)
-        stored_response_chunks: List[bytes] = list(response)
-        self.response = stored_response_chunks
-        return stored_response_chunks
+    def finish_response(
+        self, response: Iterable[bytes], on_close: Callable[[CaptureBuffer], None]
+    ) -> StreamingResponse:
+        buffer = CaptureBuffer(self.logger.rules.truncation("response_body"))
+        return StreamingResponse(response, buffer, on_close)
 
     def request_body(self, environ):
         body: bytes = b""
@@ -48,21 +70,36 @@ class HttpLoggerForFlask:
             else:
                 content_length = int(content_length)
                 body = environ["wsgi.input"].read(content_length)
-                environ["wsgi.input"] = BytesIO(bytes(body))
-
-        return decode_multipart(body) if is_multipart else body.decode("utf-8")
+            # let the app read the body again
+            environ["wsgi.input"] = BytesIO(bytes(body))
+
+        limit = self.logger.rules.truncation("request_body")
+        if is_multipart:
+            return decode_multipart(body, environ.get("CONTENT_TYPE"), limit)
+        return capture_body(
+            body,
+            environ.get("CONTENT_TYPE"),
+            limit,
+            environ.get("HTTP_CONTENT_ENCODING"),
+        )
 
-    def __call__(self, environ, start_response) -> ClosingIterator:
+    def __call__(self, environ, start_response) -> Iterable[bytes]:
+        start_time = time.time()
+        request = Request(environ)
+        if not self.logger.precheck(request.method, request.url, request.headers):
+            return self.app(environ, start_response)
 
         body__ = self.request_body(environ)
 
+        # kept per request, since threaded servers share this middleware
+        status_: List[int] = []
+        response_headers_: List[Tuple[str, str]] = []
+
         def _start_response(status, response_headers, *args):
-            self.start_response(status, response_headers)
+            status_[:] = [int(status.split(" ")[0])]
+            response_headers_[:] = response_headers
             return start_response(status, response_headers, *args)
 
-        response_chunks = self.finish_response(self.app(environ, _start_response))
-        request = Request(environ)
-
         parased_raw_params: Dict[str, List[str]] = parse.parse_qs(
             parse.urlparse(request.url).query
         )
@@ -73,22 +110,27 @@ class HttpLoggerForFlask:
         for k, v in parased_raw_params.items():
             params[k] = v[0]
 
-        HttpMessage.send(
-            self.logger,
-            request=HttpRequestImpl(
-                method=request.method,
-                url=str(request.url),
-                headers=dict(request.headers),
-                params=params,
-                body=body__,
-                remote_addr=request.remote_addr or None,
-            ),
-            response=HttpResponseImpl(
-                status=self.status,
-                body=str(self.response[0].decode()) if self.response else None,
-                headers=dict(self.response_headers),
-            ),
-            interval=str(self.interval),
-        )
-
-        return ClosingIterator(response_chunks)
+        def _log(response_body: CaptureBuffer) -> None:
+            interval = 1000.0 * (time.time() - start_time)
+            HttpMessage.send(
+                self.logger,
+                request=HttpRequestImpl(
+                    method=request.method,
+                    url=str(request.url),
+                    headers=dict(request.headers),
+                    params=params,
+                    body=body__,
+                    remote_addr=request.remote_addr or None,
+                ),
+                response=HttpResponseImpl(
+                    status=status_[0] if status_ else None,
+                    body=response_body.capture(
+                        header_value(response_headers_, "content-type"),
+                        header_value(response_headers_, "content-encoding"),
+                    ),
+                    headers=dict(response_headers_),
+                ),
+                interval=str(interval),
+            )
+
+        return self.finish_response(self.app(environ, _start_response), _log)
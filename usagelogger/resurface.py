@@ -52,7 +52,6 @@ class ResurfaceHTTPAdapter:
         self, url: Optional[str] = None, rules: Optional[str] = None, *args, **kwargs
     ):
         self.logger = HttpLogger(url=url, rules=rules)
-        self.start_time = 0
 
     def before_init_poolmanager(self, connections, maxsize, block=False):
         """Called before `HTTPAdapter::init_poolmanager`. Optionally return a
@@ -68,18 +67,25 @@ class ResurfaceHTTPAdapter:
         :param request: The `PreparedRequest` used to generate the response.
         :returns: The `Response` object or `None`.
         """
+        # timed per request, since sessions are shared across threads
+        request.usagelogger_start_time = time.perf_counter()
 
     def before_build_response(self, req, resp):
-        self.start_time = time.time()
         return req, resp
 
     def after_build_response(self, req, resp, response):
+        if not self.logger.precheck(req.method, req.url, req.headers):
+            return response
 
-        interval = str((time.time() - self.start_time) * 1000)
+        start_time = getattr(req, "usagelogger_start_time", None)
         HttpMessage.send(
             self.logger,
             request=req,
             response=response,
-            interval=interval,
+            interval=(
+                str((time.perf_counter() - start_time) * 1000)
+                if start_time is not None
+                else None
+            ),
         )
         return response
@@ -0,0 +1,40 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import random
+from typing import Iterable, Optional
+
+
+class RetryPolicy(object):
+    """Decides whether a failed submission is retried, and how long to wait
+    before each retry using exponential backoff with random jitter."""
+
+    RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        backoff: float = 0.5,
+        multiplier: float = 2.0,
+        max_backoff: float = 30.0,
+        jitter: float = 0.5,
+        retryable_statuses: Iterable[int] = RETRYABLE_STATUSES,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retryable_statuses = frozenset(retryable_statuses)
+
+    def retryable(self, status: Optional[int]) -> bool:
+        """Connection errors (no status) are always retryable."""
+        return status is None or status in self.retryable_statuses
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Seconds to wait after the given number of failed attempts, honoring
+        any Retry-After the collector asked for."""
+        delay = min(self.max_backoff, self.backoff * self.multiplier ** (attempt - 1))
+        delay -= delay * self.jitter * random.random()
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+        return delay
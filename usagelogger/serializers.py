@@ -0,0 +1,152 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import json
+from abc import ABC, abstractmethod
+from json.encoder import encode_basestring_ascii
+from typing import Dict, List, Optional, Type, Union
+
+from .http_details import HttpDetails
+
+try:
+    import orjson
+except ImportError:  # optional accelerator, checked through available
+    orjson = None  # type: ignore[assignment]
+
+try:
+    import ujson
+except ImportError:  # optional accelerator
+    ujson = None
+
+
+class Serializer(ABC):
+    """Encodes messages as compact JSON, for submission in NDJSON batches and
+    for list queues and disk spools."""
+
+    # name used to select this serializer
+    name: str = ""
+
+    # False if a module this serializer depends on isn't installed
+    available: bool = True
+
+    @abstractmethod
+    def dumps(self, msg) -> str:
+        """Encodes a message as a line of JSON."""
+
+    def write(self, msg, out: bytearray) -> None:
+        """Appends a message encoded as UTF-8, or raises without appending
+        anything if the message can't be encoded."""
+        out += self.dumps(msg).encode("utf-8")
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}()"
+
+
+class JsonSerializer(Serializer):
+    """Encodes messages with the json module from the standard library."""
+
+    name = "json"
+
+    def dumps(self, msg) -> str:
+        if isinstance(msg, HttpDetails):
+            msg = msg.pairs()
+        return json.dumps(msg, separators=(",", ":"))
+
+
+class DetailsSerializer(Serializer):
+    """Encodes lists of [key, value] details and HttpDetails by hand, using the
+    string escaping of the json module and nothing else, so that no encoder
+    objects are set up per message. Output is the same as the json module's,
+    which encodes messages of any other shape."""
+
+    name = "details"
+
+    def dumps(self, msg) -> str:
+        if isinstance(msg, HttpDetails):
+            return msg.to_json()
+        if isinstance(msg, list):
+            parts = []
+            try:
+                for d in msg:
+                    if type(d) is not list or len(d) != 2:
+                        break
+                    parts.append(
+                        "["
+                        + encode_basestring_ascii(d[0])
+                        + ","
+                        + encode_basestring_ascii(d[1])
+                        + "]"
+                    )
+                else:
+                    return "[" + ",".join(parts) + "]"
+            except TypeError:  # values that aren't strings
+                pass
+        return json.dumps(msg, separators=(",", ":"))
+
+
+class OrjsonSerializer(DetailsSerializer):
+    """Encodes messages with orjson, straight to UTF-8. Messages that orjson
+    rejects, like strings that aren't valid UTF-8, are encoded by hand."""
+
+    name = "orjson"
+    available = orjson is not None
+
+    def dumps(self, msg) -> str:
+        try:
+            return orjson.dumps(
+                msg.pairs() if isinstance(msg, HttpDetails) else msg
+            ).decode("utf-8")
+        except TypeError:
+            return super().dumps(msg)
+
+    def write(self, msg, out: bytearray) -> None:
+        try:
+            data = orjson.dumps(msg.pairs() if isinstance(msg, HttpDetails) else msg)
+        except TypeError:
+            data = super().dumps(msg).encode("utf-8")
+        out += data
+
+
+class UjsonSerializer(DetailsSerializer):
+    """Encodes messages with ujson. Messages that ujson rejects are encoded by
+    hand."""
+
+    name = "ujson"
+    available = ujson is not None
+
+    def dumps(self, msg) -> str:
+        try:
+            return ujson.dumps(
+                msg.pairs() if isinstance(msg, HttpDetails) else msg,
+                escape_forward_slashes=False,
+            )
+        except (OverflowError, TypeError, ValueError):
+            return super().dumps(msg)
+
+
+# serializers by name, fastest first
+SERIALIZERS: Dict[str, Type[Serializer]] = {
+    OrjsonSerializer.name: OrjsonSerializer,
+    UjsonSerializer.name: UjsonSerializer,
+    DetailsSerializer.name: DetailsSerializer,
+    JsonSerializer.name: JsonSerializer,
+}
+
+
+def available_serializers() -> List[str]:
+    """Names of the serializers that can be used here, fastest first."""
+    return [name for name, s in SERIALIZERS.items() if s.available]
+
+
+def select_serializer(serializer: Union[str, Serializer, None] = None) -> Serializer:
+    """Returns the given serializer, the serializer with the given name, or the
+    fastest one available."""
+    if isinstance(serializer, Serializer):
+        return serializer
+    if serializer is None:
+        serializer = available_serializers()[0]
+    cls: Optional[Type[Serializer]] = SERIALIZERS.get(serializer)
+    if cls is None:
+        raise ValueError(f"Invalid serializer: {serializer}")
+    if not cls.available:
+        raise ImportError(f"Serializer requires {serializer} to be installed")
+    return cls()
@@ -0,0 +1,32 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket that admits `rate` events per second on average,
+    with bursts of up to `capacity` events, and counts the events it drops."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, rate) if capacity is None else capacity
+        self.dropped = 0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        """Takes one token, returning False if none is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.dropped += 1
+            return False
@@ -0,0 +1,82 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import threading
+import time
+from typing import Dict, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Transport(object):
+    """Pooled HTTP connections for posting batches to a collector. Up to
+    `pool_size` connections are kept alive and shared by concurrent posts, every
+    post is bounded by connect and read timeouts, and connections left idle for
+    `idle_timeout` seconds are closed before the next post rather than reused
+    after the collector or a proxy may have dropped them. A session passed in
+    is used as is, and left for its owner to close."""
+
+    def __init__(
+        self,
+        pool_size: int = 4,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 30.0,
+        keep_alive: bool = True,
+        idle_timeout: float = 30.0,
+        session: Optional[requests.Session] = None,
+    ) -> None:
+        if pool_size < 1:
+            raise ValueError(f"Invalid pool size: {pool_size}")
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self._owns_session = session is None
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size, pool_block=True
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self._in_flight = 0
+        self._last_used = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        """Number of posts currently in progress."""
+        return self._in_flight
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        return self.connect_timeout, self.read_timeout
+
+    def post(self, url: str, data: Union[bytes, bytearray], headers: Dict[str, str]):
+        with self._lock:
+            if (
+                self._owns_session
+                and self._in_flight == 0
+                and time.monotonic() - self._last_used > self.idle_timeout
+            ):
+                self.session.close()  # drops pooled connections, not the session
+            self._in_flight += 1
+        try:
+            return self.session.post(
+                url,
+                data=data,
+                headers={
+                    **headers,
+                    "Connection": "keep-alive" if self.keep_alive else "close",
+                },
+                timeout=self.timeout,
+            )
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._last_used = time.monotonic()
+
+    def close(self) -> None:
+        self.session.close()
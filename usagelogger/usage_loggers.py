@@ -23,6 +23,10 @@ class UsageLoggers(object):
     def is_enabled(cls) -> bool:
         return not cls.__disabled
 
+    @staticmethod
+    def serializer_by_default() -> Optional[str]:
+        return getenv("USAGE_LOGGERS_SERIALIZER")
+
     @staticmethod
     def url_by_default() -> Optional[str]:
         return getenv("USAGE_LOGGERS_URL")
@@ -0,0 +1,162 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import codecs
+import re
+from typing import List, Optional, Pattern, Union
+
+# content types captured as text, including structured syntax suffixes like +json
+TEXT_CONTENT_TYPES: Pattern = re.compile(
+    r"^(text/.*|multipart/form-data|application/([\w.-]+\+)?"
+    r"(json|xml|javascript|ecmascript|x-www-form-urlencoded|graphql|yaml|x-yaml"
+    r"|ndjson|x-ndjson|csv))$"
+)
+
+# how much of a body of unknown type is inspected for binary content
+SNIFF_BYTES: int = 1024
+
+# most of a streamed body copied for logging if no truncate rule applies
+MAX_CAPTURE_BYTES: int = 1024 * 1024
+
+
+class CaptureBuffer(object):
+    """Copy of the first `limit` bytes of a body written in chunks, along with
+    the size of the whole body."""
+
+    __slots__ = ("limit", "size", "_chunks", "_kept")
+
+    def __init__(self, limit: Optional[int] = None) -> None:
+        self.limit = MAX_CAPTURE_BYTES if limit is None else limit
+        self.size = 0
+        self._chunks: List[bytes] = []
+        self._kept = 0
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        if self._kept < self.limit and data:
+            piece = bytes(data[: self.limit - self._kept])
+            self._chunks.append(piece)
+            self._kept += len(piece)
+        self.size += len(data)
+
+    def getvalue(self) -> bytes:
+        return b"".join(self._chunks)
+
+    def capture(
+        self, content_type: Optional[str] = None, content_encoding: Optional[str] = None
+    ) -> Optional[str]:
+        """Decodes what was kept as with capture_body."""
+        return capture_body(
+            self.getvalue(), content_type, None, content_encoding, self.size
+        )
+
+
+def decode_body(
+    body: Union[bytes, bytearray, memoryview, str, None],
+    limit: Optional[int] = None,
+    encoding: str = "utf-8",
+    partial: bool = False,
+) -> Optional[str]:
+    """Decodes a captured body, keeping only its first `limit` bytes so that an
+    oversized body is never decoded in full. A character cut in half by the
+    limit, or at the end of a partial body, is dropped."""
+    if body is None:
+        return None
+    if not isinstance(body, (bytes, bytearray, memoryview)):
+        body = str(body)
+    if isinstance(body, str):
+        return body if limit is None else truncate_text(body, limit)
+    if not partial and (limit is None or len(body) <= limit):
+        return bytes(body).decode(encoding)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    return decoder.decode(memoryview(body)[:limit], final=False)
+
+
+def truncate_text(text: str, limit: int) -> str:
+    """Cuts text to at most `limit` bytes of UTF-8, dropping a character cut in
+    half by the limit."""
+    if len(text) * 4 <= limit:
+        return text  # short enough however it encodes
+    text = text[:limit]
+    data = text.encode("utf-8", "surrogatepass")
+    if len(data) <= limit:
+        return text
+    return data[:limit].decode("utf-8", "ignore")
+
+
+def capture_body(
+    body: Union[bytes, bytearray, memoryview, str, None],
+    content_type: Optional[str] = None,
+    limit: Optional[int] = None,
+    content_encoding: Optional[str] = None,
+    size: Optional[int] = None,
+) -> Optional[str]:
+    """Decodes a captured body if its content type is textual, or if it has no
+    content type and doesn't look binary. Other bodies, and bodies still
+    compressed with a content encoding, are replaced by a placeholder giving
+    their size, so they are never decoded or scanned by rules. If only the
+    start of a body was kept, `size` gives its full size."""
+    if not isinstance(body, (bytes, bytearray, memoryview)):
+        return decode_body(body, limit)
+    if not body:
+        return ""
+    partial = size is not None and size > len(body)
+    if size is None:
+        size = len(body)
+    textual = is_textual(content_type)
+    if (
+        textual is False
+        or (content_encoding and content_encoding.lower() != "identity")
+        or (textual is None and looks_binary(body))
+    ):
+        return binary_placeholder(size)
+    try:
+        return decode_body(body, limit, charset(content_type), partial)
+    except UnicodeDecodeError:
+        return binary_placeholder(size)
+
+
+def binary_placeholder(size: int) -> str:
+    return f"<binary {size} bytes>"
+
+
+def charset(content_type: Optional[str]) -> str:
+    """Character set named by a content type, defaulting to UTF-8."""
+    if content_type:
+        m = re.search(r";\s*charset=\"?([\w.:-]+)", content_type, re.IGNORECASE)
+        if m:
+            try:
+                return codecs.lookup(m.group(1)).name
+            except LookupError:
+                pass
+    return "utf-8"
+
+
+def header_value(headers, name: str) -> Optional[str]:
+    """Finds a header regardless of case, in any mapping or list of pairs."""
+    if not headers:
+        return None
+    items = headers.items() if hasattr(headers, "items") else headers
+    name = name.lower()
+    for k, v in items:
+        if k.lower() == name:
+            return v
+    return None
+
+
+def is_textual(content_type: Optional[str]) -> Optional[bool]:
+    """Whether a content type is captured as text, or None if it is missing."""
+    if not content_type:
+        return None
+    mime = content_type.split(";", 1)[0].strip().lower()
+    return TEXT_CONTENT_TYPES.match(mime) is not None
+
+
+def looks_binary(body: Union[bytes, bytearray, memoryview]) -> bool:
+    """Sniffs the start of a body for NUL bytes or invalid UTF-8."""
+    sample = bytes(body[:SNIFF_BYTES])
+    if b"\x00" in sample:
+        return True
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+    except UnicodeDecodeError:
+        return True
+    return False
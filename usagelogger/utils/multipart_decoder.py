@@ -1,16 +1,187 @@
+# coding: utf-8
+# © 2016-2024 Graylog, Inc.
+import codecs
 import re
+from typing import Dict, Optional, Pattern, Union
 
+from usagelogger.utils.capture import (
+    MAX_CAPTURE_BYTES,
+    binary_placeholder,
+    decode_body,
+    is_textual,
+)
 
-def decode_multipart(body):
-    RE_PATTERN = r'(?<=; filename=")(.*?)"\\r\\nContent-Type: (.*?)\\r\\n(.*?)((-{2,})([a-zA-Z0-9_.-]+))'  # noqa
-    RE_REPLACE_TO = r'\1"\\r\\nContent-Type: \2\\r\\n\\r\\n<file-data>\\r\\n\4'
+# parser states, in the order a well-formed body moves through them
+_SNIFF, _PREAMBLE, _DELIMITER, _HEADERS, _BODY, _DONE = range(6)
 
-    return (
-        re.sub(
-            pattern=RE_PATTERN,
-            repl=RE_REPLACE_TO,
-            string="%r" % body,
-        )[2:-1]
-        .encode()
-        .decode("unicode_escape")
+# most bytes of part headers, or of a first line sniffed for the boundary
+_MAX_HEADER_BYTES: int = 16 * 1024
+
+_REGEX_LINE_END = re.compile(b"\r\n")
+_REGEX_HEADERS_END = re.compile(b"\r\n\r\n")
+_REGEX_BOUNDARY = re.compile(r";\s*boundary=(?:\"([^\"]+)\"|([^;\s]+))", re.I)
+_REGEX_FILENAME = re.compile(rb"^content-disposition:.*;\s*filename\*?=", re.I | re.M)
+_REGEX_PART_TYPE = re.compile(rb"^content-type:\s*([^\r\n]*)", re.I | re.M)
+
+
+class MultipartDecoder(object):
+    """Incremental decoder for multipart/form-data bodies written in chunks.
+    Part headers and text fields are kept, while the content of each file part
+    is skipped and replaced by a placeholder giving its size, so memory use
+    depends on the text fields rather than on the size of the upload."""
+
+    __slots__ = (
+        "limit",
+        "size",
+        "_boundary",
+        "_file",
+        "_out",
+        "_parts",
+        "_pending",
+        "_state",
+        "_tail",
+        "_terminators",
+        "_truncated",
     )
+
+    def __init__(
+        self, boundary: Union[str, bytes, None] = None, limit: Optional[int] = None
+    ) -> None:
+        self.limit = MAX_CAPTURE_BYTES if limit is None else limit
+        self.size = 0
+        self._file: Optional[int] = None
+        self._out = bytearray()
+        self._parts = 0
+        self._pending = bytearray()
+        self._tail = b""
+        self._truncated = False
+        self._state = _SNIFF
+        self._terminators: Dict[int, Pattern] = {
+            _SNIFF: _REGEX_LINE_END,
+            _HEADERS: _REGEX_HEADERS_END,
+        }
+        if boundary:
+            self.__start(
+                boundary.encode("latin-1") if isinstance(boundary, str) else boundary
+            )
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        self.size += len(data)
+        if self._state == _DONE or not data:
+            return
+        view = memoryview(self._tail + bytes(data) if self._tail else data)
+        pos, end = 0, len(view)
+        while pos < end and self._state != _DONE:
+            if self._state == _DELIMITER:
+                if end - pos < 2:
+                    break
+                if view[pos : pos + 2] == b"--":
+                    self.__emit(b"--" + self._boundary + b"--\r\n")
+                    self._state = _DONE
+                else:
+                    self._state = _HEADERS  # headers start with this line break
+                continue
+            # keep enough to find a terminator cut in two by the end of this
+            # chunk, escaped patterns being at least as long as their literals
+            terminator = self._terminators[self._state]
+            m = terminator.search(view, pos)
+            if m is None:
+                keep = max(pos, end - len(terminator.pattern) + 1)
+                self.__consume(view[pos:keep])
+                pos = keep
+                break
+            self.__consume(view[pos : m.start()])
+            pos = self.__advance(m.start(), m.end())
+        self._tail = bytes(view[pos:]) if self._state != _DONE else b""
+
+    def getvalue(self) -> str:
+        """Decodes the parts read so far, as they appeared in the body."""
+        if not self._parts and self.size:
+            return binary_placeholder(self.size)
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        return decoder.decode(bytes(self._out), final=not self._truncated)
+
+    def __advance(self, start: int, end: int) -> int:
+        """Moves to the next state on finding the current terminator, returning
+        where parsing continues."""
+        state = self._state
+        if state == _SNIFF:
+            line = bytes(self._pending).rstrip()
+            self._pending.clear()
+            if not line.startswith(b"--") or len(line) < 3:
+                self._state = _DONE
+                return end
+            self.__start(line[2:])
+            self._state = _DELIMITER
+            return start
+        if state == _PREAMBLE:
+            self._state = _DELIMITER
+        elif state == _HEADERS:
+            headers = bytes(self._pending).strip(b" \t\r\n")
+            self._pending.clear()
+            self._parts += 1
+            m = _REGEX_PART_TYPE.search(headers)
+            content_type = m.group(1).decode("latin-1").strip() if m else None
+            is_file = bool(_REGEX_FILENAME.search(headers))
+            self._file = 0 if is_file or is_textual(content_type) is False else None
+            if headers:
+                headers += b"\r\n"
+            self.__emit(b"--" + self._boundary + b"\r\n" + headers + b"\r\n")
+            self._state = _BODY
+        elif state == _BODY:
+            if self._file is not None:
+                self.__emit(file_placeholder(self._file).encode("utf-8"))
+            self.__emit(b"\r\n")
+            self._state = _DELIMITER
+        return end
+
+    def __consume(self, data: memoryview) -> None:
+        state = self._state
+        if state == _BODY:
+            if self._file is None:
+                self.__emit(data)
+            else:
+                self._file += len(data)
+        elif state in (_SNIFF, _HEADERS):
+            self._pending += data
+            if len(self._pending) > _MAX_HEADER_BYTES:
+                self._state = _DONE
+
+    def __emit(self, data: Union[bytes, memoryview]) -> None:
+        room = self.limit - len(self._out)
+        if len(data) > room:
+            self._out += data[:room]
+            self._truncated = True
+            self._state = _DONE  # nothing more can be kept
+        else:
+            self._out += data
+
+    def __start(self, boundary: bytes) -> None:
+        self._boundary = boundary
+        self._state = _PREAMBLE
+        self._terminators[_PREAMBLE] = re.compile(re.escape(b"--" + boundary))
+        self._terminators[_BODY] = re.compile(re.escape(b"\r\n--" + boundary))
+
+
+def decode_multipart(
+    body: Union[bytes, bytearray, memoryview, str, None],
+    content_type: Optional[str] = None,
+    limit: Optional[int] = None,
+) -> Optional[str]:
+    """Decodes a multipart/form-data body, replacing the content of file parts
+    with a placeholder giving their size."""
+    if not isinstance(body, (bytes, bytearray, memoryview)):
+        return decode_body(body, limit)
+    decoder = MultipartDecoder(multipart_boundary(content_type), limit)
+    decoder.write(body)
+    return decoder.getvalue()
+
+
+def file_placeholder(size: int) -> str:
+    return f"<file-data {size} bytes>"
+
+
+def multipart_boundary(content_type: Optional[str]) -> Optional[str]:
+    """Boundary named by a multipart content type, if any."""
+    m = _REGEX_BOUNDARY.search(content_type or "")
+    return (m.group(1) or m.group(2)) if m else None